@@ -0,0 +1,273 @@
+# coding: utf-8
+# 离线基准测试，不需要 MySQL，使用内存中的假连接池代替 Database 连接
+# python benchmark.py --rows 10000,100000,1000000 --output result.json
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from data_handler import Database, Model, Field, Q, F, Query
+
+
+# 模拟 pymysql 游标，select 返回预设的行
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+        self.rows = ()
+        self.rowcount = 0
+        self.lastrowid = 0
+        self.pos = 0
+
+    def execute(self, sql, params=None):
+        self.rows = self.pool.rows if sql.lstrip().startswith('select') else ()
+        self.rowcount = len(self.rows) or 1
+        self.lastrowid = 1
+        self.pos = 0
+        return self.rowcount
+
+    def executemany(self, sql, seq_params):
+        self.rows = ()
+        self.rowcount = len(seq_params)
+        return self.rowcount
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, cursor=None):
+        return FakeCursor(self.pool)
+
+    def autocommit(self, value):
+        pass
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.rows = ()
+
+    def get_connection(self):
+        return FakeConnection(self)
+
+
+class BenchModelBasic(Model):
+    id = Field(primary_key=True)
+    a = Field()
+
+    class Meta:
+        abstract = True
+
+
+class BenchModel(BenchModelBasic):
+    b = Field(db_column='bb')
+    c = Field()
+    d = Field()
+
+    class Meta:
+        db_table = 'bench'
+        db_label = 'default'
+
+
+class BenchSlotsModel(BenchModelBasic):
+    b = Field(db_column='bb')
+    c = Field()
+    d = Field()
+
+    class Meta:
+        db_table = 'bench'
+        db_label = 'default'
+        slots = True
+
+
+class BenchForeignModel(BenchModelBasic):
+    e = Field()
+
+    class Meta:
+        db_table = 'bench_foreign'
+        db_label = 'default'
+
+
+# 多次运行取最短耗时
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def deep_q(depth):
+    q = Q(a='x0') | Q(b__gte=0)
+    for i in range(1, depth):
+        q = (q & Q(c__in=[i, i + 1])) | ~Q(d__contains='y%d' % i)
+    return q
+
+
+def bench_sql_expr(repeat, loops=2000):
+    result = {}
+    deep_query = BenchModel.objects.filter(deep_q(8)).order_by('-b', 'a')[10:20].query
+    join_query = BenchModel.objects.join(BenchForeignModel, 'f1', a='f1__a').join(
+        BenchForeignModel, 'f2', id='f2__id').filter(f1__e__gt=1, f2__e__lt=F('b') + 1).order_by('f1__e').query
+    for name, query in [('deep_q', deep_query), ('multi_join', join_query)]:
+        def cold():
+            for _ in range(loops):
+                Query.sql_cache.clear()
+                query.sql_expr()
+
+        def warm():
+            for _ in range(loops):
+                query.sql_expr()
+
+        result[name] = {
+            'cold_ops_per_sec': loops / best_of(cold, repeat),
+            'cached_ops_per_sec': loops / best_of(warm, repeat),
+        }
+    return result
+
+
+def bench_clone(repeat, loops=20000):
+    def chain():
+        for i in range(loops):
+            BenchModel.objects.filter(a='x').filter(b__gt=i).exclude(c=1).order_by('-d')[:10]
+
+    return {'filter_chain_ops_per_sec': loops / best_of(chain, repeat)}
+
+
+def make_rows(count):
+    return tuple((i, 'a%d' % i, i % 100, 'c%d' % (i % 7), float(i)) for i in range(count))
+
+
+def bench_hydration(pool, sizes, repeat):
+    result = {}
+    for count in sizes:
+        pool.rows = make_rows(count)
+        cases = {
+            'model': lambda: list(BenchModel.objects.all()),
+            'slots_model': lambda: list(BenchSlotsModel.objects.all()),
+            'values': lambda: list(BenchModel.objects.values()),
+            'values_list': lambda: list(BenchModel.objects.values_list('id', 'a', 'b', 'c', 'd')),
+            'iterator': lambda: sum(1 for _ in BenchModel.objects.iterator(2000)),
+        }
+        size_result = {}
+        for name, func in cases.items():
+            seconds = best_of(func, repeat)
+            size_result[name] = {'seconds': seconds, 'ns_per_row': seconds / count * 1e9}
+        result[str(count)] = size_result
+        pool.rows = ()
+    return result
+
+
+def bench_bulk_create(sizes, repeat):
+    result = {}
+    for count in sizes:
+        def run():
+            objs = [BenchModel(a='a%d' % i, b=i, c='c', d=1.5) for i in range(count)]
+            BenchModel.objects.bulk_create(objs, batch_size=1000)
+
+        seconds = best_of(run, repeat)
+        result[str(count)] = {'seconds': seconds, 'ns_per_row': seconds / count * 1e9}
+    return result
+
+
+# tracemalloc 统计转换全部结果时的峰值内存
+def bench_memory(pool, sizes):
+    result = {}
+    for count in sizes:
+        pool.rows = make_rows(count)
+        size_result = {}
+        for name, func in [('model', lambda: list(BenchModel.objects.all())),
+                           ('slots_model', lambda: list(BenchSlotsModel.objects.all())),
+                           ('iterator', lambda: sum(1 for _ in BenchModel.objects.iterator(2000)))]:
+            gc.collect()
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size_result[name] = {'peak_bytes': peak, 'bytes_per_row': peak / count}
+        result[str(count)] = size_result
+        pool.rows = ()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for data_handler.')
+    parser.add_argument('--rows', default='10000,100000,1000000', help='comma separated row counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write JSON to this file instead of stdout')
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.rows.split(',') if x]
+
+    pool = FakePool()
+    Database.conn['default'] = pool
+
+    result = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sql_expr': bench_sql_expr(args.repeat),
+        'clone': bench_clone(args.repeat),
+        'hydration': bench_hydration(pool, sizes, args.repeat),
+        'bulk_create': bench_bulk_create(sizes, args.repeat),
+        'memory': bench_memory(pool, sizes),
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
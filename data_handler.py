@@ -1,8 +1,61 @@
 # coding: utf-8
 
+import array
+import base64
+import contextvars
+import csv
+import heapq
+import io
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from gzip import GzipFile
+from itertools import chain, cycle, islice
+from types import MappingProxyType
+
 # https://pypi.org/project/pymysql-pool/
+import pymysql
 import pymysqlpool
 
+# https://pypi.org/project/aiomysql/ 可选，AsyncDatabase 使用
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+# https://pypi.org/project/numpy/ 可选，to_columns 使用，未安装时使用 array.array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# https://pypi.org/project/pyarrow/ 可选，export parquet 使用
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+# 继承 TypeError，与其它查询错误一致
+class ObjectDoesNotExist(TypeError):
+    pass
+
+
+class MultipleObjectsReturned(TypeError):
+    pass
+
 
 class Aggregate:
     func = '%s'
@@ -45,6 +98,12 @@ class Field:
         self.db_column = kw.get('db_column', None)
         self.name = kw.get('name', None)
 
+    # 实例上没有该字段值时（only/defer 延迟加载）交给 Model.__getattr__ 处理
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        raise AttributeError(self.name)
+
 
 class Combinable:
 
@@ -101,6 +160,14 @@ class CombinedExpression(Combinable):
         self.rhs = rhs
 
 
+# case field when value then result ... else default end
+class Case(Combinable):
+    def __init__(self, field, whens, default=None):
+        self.field = field
+        self.whens = list(whens)
+        self.default = default
+
+
 class Q:
     def __init__(self, *args, **kwargs):
         self.children = list(args) + list(kwargs.items())
@@ -157,6 +224,115 @@ class Q:
         return template % (self.connector, ', '.join(str(c) for c in self.children))
 
 
+# 数据库方言，按库标签配置 backend: 'mysql'（默认）或 'sqlite'
+# 字段名统一使用反引号，SQLite 同样支持
+class MySQLBackend:
+    name = 'mysql'
+    # 查询条件运算符
+    operators = MappingProxyType({
+        '': ' = %s ',
+        'gt': ' > %s ',
+        'gte': ' >= %s ',
+        'lt': ' < %s ',
+        'lte': ' <= %s ',
+        'contains': ' like CONCAT("%%", %s, "%%") ',
+        'startswith': ' like CONCAT(%s, "%%") ',
+        'endswith': ' like CONCAT("%%", %s) ',
+    })
+    # 只有 offset 时使用的 limit
+    max_limit = 18446744073709551615
+    insert_ignore = 'insert ignore into'
+    # 单条语句的参数个数限制，None 不限制
+    max_params = None
+    # upsert 是否使用 returning 取得主键
+    upsert_returning = False
+    stream_cursor = pymysql.cursors.SSCursor
+    # 查询自增步长的sql，None 时步长为 1
+    auto_increment_sql = 'select @@auto_increment_increment;'
+
+    def __init__(self):
+        # 各库的自增步长 auto_increment_increment，多主复制时大于 1
+        self.auto_increment_steps = {}
+
+    @staticmethod
+    def create_pool(db_config):
+        return pymysqlpool.ConnectionPool(size=db_config.get('pool_min', 1),
+                                          maxsize=db_config.get('pool_max', 1),
+                                          pre_create_num=db_config.get('pool_min', 1),
+                                          name=db_config.get('database', 'test'),
+                                          host=db_config.get('host', 'localhost'),
+                                          port=int(db_config.get('port', 3306)),
+                                          user=db_config.get('user', 'root'),
+                                          password=db_config.get('password', ''),
+                                          database=db_config.get('database', 'test'),
+                                          charset=db_config.get('charset', 'utf8'),
+                                          autocommit=True)
+
+    @staticmethod
+    def table_name(database, db_table):
+        return '`%s`.`%s`' % (database, db_table) if database else '`%s`' % db_table
+
+    @staticmethod
+    def upsert_sql(columns, pk_column=None):
+        update_list = ['%s = values(%s)' % (x, x) for x in columns]
+        if pk_column:
+            # 更新时 lastrowid 返回已存在行的主键
+            update_list.append('{0} = LAST_INSERT_ID({0})'.format(pk_column))
+        if not update_list:
+            raise TypeError('No fields to update in upsert.')
+        return ' on duplicate key update ' + ', '.join(update_list)
+
+    # 多行 insert 的第一个自增主键，MySQL 的 lastrowid 即为第一行
+    @staticmethod
+    def first_insert_id(lastrowid, rowcount, step=1):
+        return lastrowid
+
+
+class SQLiteBackend(MySQLBackend):
+    name = 'sqlite'
+    operators = MappingProxyType({
+        '': ' = %s ',
+        'gt': ' > %s ',
+        'gte': ' >= %s ',
+        'lt': ' < %s ',
+        'lte': ' <= %s ',
+        'contains': " like '%%' || %s || '%%' ",
+        'startswith': " like %s || '%%' ",
+        'endswith': " like '%%' || %s ",
+    })
+    max_limit = -1
+    insert_ignore = 'insert or ignore into'
+    # SQLITE_MAX_VARIABLE_NUMBER 默认值
+    max_params = 32766
+    upsert_returning = True
+    stream_cursor = None
+    auto_increment_sql = None
+
+    # database 为文件路径，':memory:' 为进程内共享的内存库
+    @staticmethod
+    def create_pool(db_config):
+        return SQLitePool(db_config.get('database', ':memory:'), db_config.get('pool_max', 1))
+
+    # 一个连接只对应一个库，不带库名
+    @staticmethod
+    def table_name(database, db_table):
+        return '`%s`' % db_table
+
+    @staticmethod
+    def upsert_sql(columns, pk_column=None):
+        if not columns:
+            raise TypeError('No fields to update in upsert.')
+        return ' on conflict do update set ' + ', '.join('%s = excluded.%s' % (x, x) for x in columns)
+
+    # SQLite 的 lastrowid 为最后一行
+    @staticmethod
+    def first_insert_id(lastrowid, rowcount, step=1):
+        return lastrowid - (rowcount - 1) * step
+
+
+BACKENDS = {'mysql': MySQLBackend, 'sqlite': SQLiteBackend}
+
+
 class WhereNode:
     def __init__(self, model):
         self.join_as = {}
@@ -204,10 +380,12 @@ class WhereNode:
         if isinstance(value, F):
             field_name = ModelCheck(self).field_info(value.name)
             return field_name, []
+        if isinstance(value, Case):
+            return self.case_expr(value)
         params = []
         raw_sql_list = []
         for temp_f in [value.lhs, value.rhs]:
-            if isinstance(temp_f, (F, CombinedExpression)):
+            if isinstance(temp_f, (F, CombinedExpression, Case)):
                 temp_sql, temp_params = self.f_expr(temp_f)
                 if hasattr(temp_f, 'connector') and temp_f.connector != value.connector:
                     temp_sql = '(' + temp_sql + ')'
@@ -218,22 +396,25 @@ class WhereNode:
         raw_sql = value.connector.join(raw_sql_list)
         return raw_sql, params
 
-    # 处理双下划线特殊查询
-    def magic_query(self, child_query):
-        correspond_dict = {
-            '': ' = %s ',
-            'gt': ' > %s ',
-            'gte': ' >= %s ',
-            'lt': ' < %s ',
-            'lte': ' <= %s ',
-            'contains': ' like CONCAT("%%", %s, "%%") ',
-            'startswith': ' like CONCAT(%s, "%%") ',
-            'endswith': ' like CONCAT("%%", %s) ',
-        }
-        raw_sql = ''
+    def case_expr(self, value):
+        sql_list = [' case ' + ModelCheck(self).field_info(value.field)]
         params = []
+        for index, result in enumerate([x[1] for x in value.whens] + [value.default]):
+            if isinstance(result, (F, CombinedExpression, Case)):
+                temp_sql, temp_params = self.f_expr(result)
+            else:
+                temp_sql, temp_params = '%s', [result]
+            if index < len(value.whens):
+                sql_list.append(' when %s then ' + temp_sql)
+                params.append(value.whens[index][0])
+            else:
+                sql_list.append(' else ' + temp_sql)
+            params.extend(temp_params)
+        return ''.join(sql_list) + ' end ', params
+
+    # 解析双下划线查询，返回 (模型, 字段, 查询类型)
+    def parse_lookup(self, query_str):
         temp_model = self.model
-        query_str, value = child_query
         if '__' in query_str:
             field = magic = ''
             temp_field, *magic_list = query_str.split('__')
@@ -250,8 +431,16 @@ class WhereNode:
                 raise TypeError('Cannot resolve keyword %s into field.' % temp_field)
         else:
             field, magic = query_str, ''
+        return temp_model, field, magic
+
+    # 处理双下划线特殊查询
+    def magic_query(self, child_query):
+        raw_sql = ''
+        params = []
+        query_str, value = child_query
+        temp_model, field, magic = self.parse_lookup(query_str)
         field = temp_model.field_info(field)
-        temp_sql = correspond_dict.get(magic)
+        temp_sql = self.model._meta.backend.operators.get(magic)
         if temp_sql:
             raw_sql = ' ' + field + temp_sql
             params = [value]
@@ -296,6 +485,75 @@ class WhereNode:
 
         return raw_sql, params
 
+    # 查询结构指纹及参数，参数顺序与 _sql_expr 一致
+    def query_shape(self, q_query=None):
+        if q_query is None:
+            q_query = self.filter_Q
+        shape = []
+        params = []
+        for child in q_query.children:
+            if isinstance(child, Q):
+                temp_shape, temp_params = self.query_shape(child)
+                shape.append((child.connector, child.negated, temp_shape))
+            else:
+                temp_shape, temp_params = self.lookup_shape(child)
+                shape.append(temp_shape)
+            params.extend(temp_params)
+        return tuple(shape), params
+
+    def lookup_shape(self, child_query):
+        query_str, value = child_query
+        magic = self.parse_lookup(query_str)[2]
+        if magic in self.model._meta.backend.operators:
+            if isinstance(value, (F, CombinedExpression)):
+                value_shape, params = self.f_shape(value)
+            else:
+                value_shape, params = None, [value]
+        elif magic == 'isnull':
+            value_shape, params = bool(value), []
+        elif magic == 'range':
+            value_shape, params = None, list(value)
+        elif magic == 'in':
+            if isinstance(value, (ValuesListQuerySet, ValuesQuerySet, QuerySet)):
+                subquery = value.query.clone()
+                if type(value) == QuerySet:
+                    subquery.select = [value.model.__primary_key__]
+                value_shape, params = subquery.cache_key()
+            elif len(value) == 0:
+                value_shape, params = False, []
+            else:
+                value_shape, params = True, [tuple(value)]
+        else:
+            value_shape, params = None, []
+        return (query_str, value_shape), params
+
+    def f_shape(self, value):
+        if isinstance(value, F):
+            return value.name, []
+        if isinstance(value, Case):
+            shape = ['case', value.field]
+            params = []
+            for index, result in enumerate([x[1] for x in value.whens] + [value.default]):
+                if index < len(value.whens):
+                    params.append(value.whens[index][0])
+                if isinstance(result, (F, CombinedExpression, Case)):
+                    temp_shape, temp_params = self.f_shape(result)
+                else:
+                    temp_shape, temp_params = None, [result]
+                shape.append(temp_shape)
+                params.extend(temp_params)
+            return tuple(shape), params
+        shape = [value.connector]
+        params = []
+        for temp_f in [value.lhs, value.rhs]:
+            if isinstance(temp_f, (F, CombinedExpression, Case)):
+                temp_shape, temp_params = self.f_shape(temp_f)
+            else:
+                temp_shape, temp_params = None, [temp_f]
+            shape.append(temp_shape)
+            params.extend(temp_params)
+        return tuple(shape), params
+
     def _add_q(self, q_object):
         self.filter_Q.add(q_object, 'AND')
 
@@ -309,7 +567,125 @@ class WhereNode:
         return bool(self.filter_Q)
 
 
+# 编译sql缓存，按查询结构指纹缓存sql模板，LRU淘汰
+class SQLCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            sql = self._data.get(key)
+            if sql is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return sql
+
+    def set(self, key, sql):
+        with self._lock:
+            self._data[key] = sql
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# 查询结果缓存，键为 (db_label, sql, params)，按估算字节数限制大小，写操作时按表失效
+# 可替换为实现 get / version / set / invalidate 的其它缓存
+class ResultCache:
+    def __init__(self, maxbytes=64 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._tables = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] is not None and item[0] < time.monotonic():
+                self._pop(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[1]
+
+    # 各表的写版本，查询前取得，写入缓存时版本已变化说明期间有写操作，不缓存
+    def version(self, tables):
+        with self._lock:
+            return tuple(self._versions.get(x, 0) for x in tables)
+
+    def set(self, key, value, ttl=None, tables=(), version=None):
+        nbytes = _result_size(value)
+        if nbytes > self.maxbytes:
+            return
+        with self._lock:
+            if version is not None and version != tuple(self._versions.get(x, 0) for x in tables):
+                return
+            if key in self._data:
+                self._pop(key)
+            expires = None if ttl is None else time.monotonic() + ttl
+            self._data[key] = (expires, value, nbytes, tables)
+            self.nbytes += nbytes
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while self.nbytes > self.maxbytes:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _pop(self, key):
+        _, _, nbytes, tables = self._data.pop(key)
+        self.nbytes -= nbytes
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    # 表有写操作时删除相关的缓存
+    def invalidate(self, table):
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            for key in list(self._tables.get(table, ())):
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tables.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data),
+                'bytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+
+_MISSING = object()
+
+
 class Query:
+    sql_cache = SQLCache()
+
     def __init__(self, model):
         self.model = model
         self.fields_list = self.model.field_list
@@ -322,14 +698,75 @@ class Query:
         self.limit_dict = {}
         self.distinct = False
         self.order_fields = []
+        self.deferred = frozenset()
+        self.prefetches = []
         self.where = WhereNode(model)
 
     def __str__(self):
         sql, params = self.sql_expr()
         return sql % params
 
-    # 根据当前筛选条件构建sql、params
+    # 根据当前筛选条件构建sql、params，相同结构的查询复用缓存的sql模板
     def sql_expr(self, method='select', update_dict=None):
+        if Instrumentation.timing:
+            start = time.perf_counter()
+            result = self._sql_expr(method, update_dict)
+            Instrumentation.record('compile', 1, time.perf_counter() - start)
+            return result
+        return self._sql_expr(method, update_dict)
+
+    def _sql_expr(self, method, update_dict):
+        key, params = self.cache_key(method, update_dict)
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql, params = self.compile(method, update_dict)
+            self.sql_cache.set(key, sql)
+            return sql, params
+        return sql, tuple(params)
+
+    # 查询结构指纹，只包含影响sql文本的部分，参数单独收集
+    def cache_key(self, method='select', update_dict=None):
+        limit = self.limit_dict.get('limit')
+        offset = self.limit_dict.get('offset')
+
+        update_shape = []
+        params = []
+        if method == 'update' and update_dict:
+            for key, val in update_dict.items():
+                if key not in self.fields_list:
+                    continue
+                if isinstance(val, (F, CombinedExpression, Case)):
+                    temp_shape, temp_params = self.where.f_shape(val)
+                else:
+                    temp_shape, temp_params = None, [val]
+                update_shape.append((key, temp_shape))
+                params.extend(temp_params)
+
+        where_shape = ()
+        if self.where:
+            where_shape, where_params = self.where.query_shape()
+            params.extend(where_params)
+
+        if method == 'exists':
+            if offset is not None:
+                params.append(offset)
+        else:
+            if limit is None and offset is not None:
+                limit = self.model._meta.backend.max_limit
+            if limit is not None:
+                params.append(limit)
+            if offset is not None:
+                params.append(offset)
+
+        key = (method, self.model, tuple(update_shape), where_shape,
+               tuple((k, v['join_model'], v['join_on']) for k, v in self.join_as.items()),
+               tuple(self.select), self.deferred, self.distinct, tuple(self.group_by), tuple(self.order_fields),
+               tuple((k, v.__class__, v.func, v.field) for k, v in self.annotates.items()),
+               limit is not None, bool(limit), offset is not None)
+        return key, params
+
+    # 编译sql
+    def compile(self, method='select', update_dict=None):
 
         limit = self.limit_dict.get('limit')
         offset = self.limit_dict.get('offset')
@@ -343,15 +780,15 @@ class Query:
 
         check_obj = ModelCheck(self)
         field_info = check_obj.field_info
-        table_info = self.model.table_info()
+        table_info = self.model._meta.table_info
 
         # join
         join_sql = ''
         join_field = []
         for table_as, join_info in self.join_as.items():
             join_model, join_on = join_info['join_model'], join_info['join_on']
-            join_field.extend(field_info(table_as + '__' + x) for x in join_model.field_list)
-            temp_join = ' join ' + join_model.table_info() + ' on '
+            join_field.extend(join_model._meta.column_list)
+            temp_join = ' join ' + join_model._meta.table_info + ' on '
             on_list = []
             for k, v in join_on:
                 on_list.append(field_info(k) + ' = ' + field_info(v))
@@ -368,8 +805,9 @@ class Query:
         if self.group_by:
             where_expr += ' group by ' + ', '.join(field_info(x) for x in self.group_by)
 
+        order_expr = ''
         if self.order_fields:
-            where_expr += ' order by '
+            order_expr += ' order by '
             order_list = []
             for field in self.order_fields:
                 if field[0] == '-':
@@ -377,17 +815,19 @@ class Query:
                     order_list.append(field_info(field_name) + ' desc ')
                 else:
                     order_list.append(field_info(field))
-            where_expr += ' , '.join(order_list)
+            order_expr += ' , '.join(order_list)
 
         # limit offset
+        limit_expr = ''
+        limit_params = []
         if limit is None and offset is not None:
-            limit = 18446744073709551615
+            limit = self.model._meta.backend.max_limit
         if limit is not None:
-            where_expr += ' limit %s '
-            params.append(limit)
+            limit_expr += ' limit %s '
+            limit_params.append(limit)
         if offset is not None:
-            where_expr += ' offset %s '
-            params.append(offset)
+            limit_expr += ' offset %s '
+            limit_params.append(offset)
 
         # 构建不同操作的sql语句
         if method == 'update' and update_dict:
@@ -398,40 +838,65 @@ class Query:
                     continue
                 temp_key = ' = %s'
                 temp_params = [val]
-                if isinstance(val, (F, CombinedExpression)):
+                if isinstance(val, (F, CombinedExpression, Case)):
                     f_sql, f_params = self.where.f_expr(val)
                     temp_key = ' = ' + f_sql
                     temp_params = f_params
-                _keys.append(field_info(key) + temp_key)
+                # 没有 join 时 set 使用不带表名的列名，SQLite 不支持带表名
+                set_column = field_info(key) if self.join_as else '`%s`' % self.model._meta.db_columns[key]
+                _keys.append(set_column + temp_key)
                 _params.extend(temp_params)
-            params = _params + params
-            sql = 'update %s set %s %s;' % (table_info, ', '.join(_keys), where_expr)
+            params = _params + params + limit_params
+            sql = 'update %s set %s %s;' % (table_info, ', '.join(_keys), where_expr + order_expr + limit_expr)
         elif method == 'delete':
-            sql = 'delete from %s %s;' % (table_info, where_expr)
-        else:
-
-            if self.select:
-                field_list = [field_info(x) for x in self.select]
+            params += limit_params
+            sql = 'delete from %s %s;' % (table_info, where_expr + order_expr + limit_expr)
+        elif method == 'exists':
+            # 只需判断是否有数据，不排序、不取字段
+            select_field = '1'
+            if self.distinct:
+                select_field = 'distinct ' + ', '.join(self._select_fields(field_info, join_field))
+            sql = 'select %s from %s %s limit 1' % (select_field, table_info, where_expr)
+            if offset is not None:
+                sql += ' offset %s '
+                params.append(offset)
+            sql += ';'
+        elif method == 'count':
+            # 计数与排序无关，不需要 order by
+            params += limit_params
+            if self.distinct or self.group_by or limit is not None:
+                select_field = '1'
+                if self.distinct:
+                    select_field = 'distinct ' + ', '.join(self._select_fields(field_info, join_field))
+                sql = 'select count(*) from (select %s from %s %s) subquery;' % (
+                    select_field, table_info, where_expr + limit_expr)
             else:
-                field_list = [field_info(x) for x in self.fields_list]
-                field_list.extend(join_field)
-
-            # 聚合查询
-            for k, v in self.annotates.items():
-                if k in field_list:
-                    k_index = field_list.index(k)
-                    field_list[k_index] = '%s as %s' % (v.sql_expr(field_info), k)
-            select_field = ', '.join(field_list)
-            subquery = 'select %s %s from %s %s' % (
-                'distinct' if self.distinct else '', select_field, table_info, where_expr)
-            if method == 'count' and (self.distinct or limit):
-                sql = 'select count(*) from (%s) subquery;' % subquery
-            elif method == 'count':
                 sql = 'select count(*) from %s %s;' % (table_info, where_expr)
-            else:
-                sql = subquery + ';'
+        else:
+            params += limit_params
+            select_field = ', '.join(self._select_fields(field_info, join_field))
+            sql = 'select %s %s from %s %s;' % (
+                'distinct' if self.distinct else '', select_field, table_info, where_expr + order_expr + limit_expr)
         return sql, tuple(params)
 
+    def _select_fields(self, field_info, join_field):
+        if self.select:
+            field_list = [field_info(x) for x in self.select]
+        elif self.deferred:
+            columns = self.model._meta.columns
+            field_list = [columns[x] for x in self.model._meta.loaded_fields(self.deferred)]
+            field_list.extend(join_field)
+        else:
+            field_list = list(self.model._meta.column_list)
+            field_list.extend(join_field)
+
+        # 聚合查询
+        for k, v in self.annotates.items():
+            if k in field_list:
+                k_index = field_list.index(k)
+                field_list[k_index] = '%s as %s' % (v.sql_expr(field_info), k)
+        return field_list
+
     # clone
     def clone(self):
         obj = Query(self.model)
@@ -444,15 +909,178 @@ class Query:
         obj.annotates.update(self.annotates)
         obj.limit_dict.update(self.limit_dict)
         obj.order_fields = self.order_fields[:]
+        obj.deferred = self.deferred
+        obj.prefetches = self.prefetches[:]
         return obj
 
 
 class QuerySet(object):
+    result_cache = ResultCache()
+
     def __init__(self, model, query=None):
         self.model = model
         self.select_result = None
         self.query = query or Query(model)
         self.fields_list = self.model.field_list
+        self._db_label = None
+        self._for_write = False
+        self._cache = False
+        self._cache_ttl = None
+
+    # 执行查询使用的数据库，分片模型的查询涉及多个分片时不可用
+    @property
+    def db_label(self):
+        db_labels = self._shard_labels()
+        if len(db_labels) > 1:
+            raise TypeError('Query spans multiple shards, filter by the shard key or use using().')
+        return db_labels[0]
+
+    # 查询涉及的数据库，分片模型按分片键条件路由，没有分片键条件时为全部分片
+    def _shard_labels(self):
+        if self._db_label:
+            return [self._db_label]
+        meta = self.model._meta
+        if not meta.shards:
+            return [self.model.__db_label__]
+        values = self._shard_key_values(self.query.where.filter_Q)
+        if values is None:
+            return list(meta.shards)
+        return list(OrderedDict.fromkeys(meta.shard_for(x) for x in values))
+
+    # 从 and 条件中取得分片键的值（= 或 in）
+    def _shard_key_values(self, q_object):
+        if q_object.negated or q_object.connector != 'AND':
+            return None
+        names = self.model._meta.names
+        shard_key = self.model._meta.shard_key
+        for child in q_object.children:
+            if isinstance(child, Q):
+                values = self._shard_key_values(child)
+                if values is not None:
+                    return values
+                continue
+            key, value = child
+            if isinstance(value, Combinable):
+                continue
+            if names.get(key) == shard_key:
+                return [value]
+            if key.endswith('__in') and names.get(key[:-4]) == shard_key:
+                return list(value)
+        return None
+
+    # 分片查询：各分片 limit 为 offset + limit，合并后再取全局 offset、limit
+    def _shard_query(self):
+        query = self.query.clone()
+        if query.distinct or query.group_by or query.annotates:
+            raise TypeError('Cannot use distinct, group_by or annotate across shards.')
+        offset = query.limit_dict.pop('offset', None) or 0
+        if 'limit' in query.limit_dict:
+            query.limit_dict['limit'] += offset
+        return query
+
+    # 合并各分片结果，有 order_by 时按排序字段多路归并
+    def _merge_shards(self, results):
+        order_fields = self.query.order_fields
+        if order_fields:
+            names = self.model._meta.names
+            row_fields = self._row_fields()
+            indexes = []
+            desc = []
+            for field in order_fields:
+                name = field.lstrip('-')
+                name = names.get(name, name)
+                if name not in row_fields:
+                    raise TypeError('Cannot merge shards ordered by %s, it is not selected.' % name)
+                indexes.append(row_fields.index(name))
+                desc.append(field[0] == '-')
+            rows = heapq.merge(*results, key=lambda row: _MergeKey([row[x] for x in indexes], desc))
+        else:
+            rows = chain.from_iterable(results)
+        offset = self.query.limit_dict.get('offset') or 0
+        limit = self.query.limit_dict.get('limit')
+        return islice(rows, offset, None if limit is None else offset + limit)
+
+    # 结果行中各列对应的字段名
+    def _row_fields(self):
+        row_fields = list(self.model._meta.loaded_fields(self.query.deferred))
+        for table_as, join_info in self.query.join_as.items():
+            row_fields.extend(table_as + '__' + x for x in join_info['join_model'].field_list)
+        return row_fields
+
+    # 在各分片并发执行，fetch='none' 为写操作，执行后使结果缓存失效
+    def _shard_execute(self, db_labels, sql, params, fetch='all'):
+        if fetch != 'none':
+            return Database.fan_out(lambda x: self._execute(x, sql, params, fetch), db_labels)
+        results = Database.fan_out(lambda x: Database.execute(x, sql, params, fetch='none'), db_labels)
+        self.result_cache.invalidate(self.model._meta.table_info)
+        return results
+
+    # 指定数据库
+    def using(self, db_label):
+        clone = self._clone()
+        clone._db_label = db_label
+        return clone
+
+    # 读查询使用主库
+    def primary(self):
+        clone = self._clone()
+        clone._for_write = True
+        return clone
+
+    # 缓存查询结果（select、count、exists），ttl 为秒数，None 表示直到写操作失效或被淘汰
+    def cache(self, ttl=None):
+        clone = self._clone()
+        clone._cache = True
+        clone._cache_ttl = ttl
+        return clone
+
+    # 查询涉及的表（含 join 及 in 子查询），用于缓存失效
+    def _tables(self):
+        tables = [self.model._meta.table_info]
+        tables.extend(x['join_model']._meta.table_info for x in self.query.join_as.values())
+        tables.extend(self._subquery_tables(self.query.where.filter_Q))
+        return tuple(OrderedDict.fromkeys(tables))
+
+    @classmethod
+    def _subquery_tables(cls, q_object):
+        for child in q_object.children:
+            if isinstance(child, Q):
+                yield from cls._subquery_tables(child)
+            elif isinstance(child[1], QuerySet):
+                yield from child[1]._tables()
+
+    # 执行读查询，使用 cache() 时先查找结果缓存
+    # 事务块内不使用缓存，未提交的结果不写入缓存，回滚后也不会读到
+    def _execute(self, db_label, sql, params, fetch='all'):
+        if not self._cache or db_label in _atomic_blocks.get():
+            return Database.execute(db_label, sql, params, fetch=fetch, read=not self._for_write)
+        cache = self.result_cache
+        key = (db_label, sql, _freeze(params), fetch)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            tables = self._tables()
+            version = cache.version(tables)
+            result = Database.execute(db_label, sql, params, fetch=fetch, read=not self._for_write)
+            if fetch == 'all':
+                result = tuple(result)
+            cache.set(key, result, self._cache_ttl, tables, version)
+        return result
+
+    async def _aexecute(self, sql, params, fetch='all'):
+        db_label = self.db_label
+        if not self._cache:
+            return await AsyncDatabase.execute(db_label, sql, params, fetch=fetch)
+        cache = self.result_cache
+        key = (db_label, sql, _freeze(params), fetch)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            tables = self._tables()
+            version = cache.version(tables)
+            result = await AsyncDatabase.execute(db_label, sql, params, fetch=fetch)
+            if fetch == 'all':
+                result = tuple(result)
+            cache.set(key, result, self._cache_ttl, tables, version)
+        return result
 
     # all函数，返回一个新的QuerySet对象（无筛选条件）
     def all(self):
@@ -477,8 +1105,17 @@ class QuerySet(object):
     def count(self):
         if self.select_result is not None:
             return len(self.select_result)
+        db_labels = self._shard_labels()
+        if len(db_labels) > 1:
+            query = self._shard_query()
+            query.limit_dict.clear()
+            sql, params = query.sql_expr(method='count')
+            results = self._shard_execute(db_labels, sql, params, fetch='one')
+            select_count = max(sum(x[0] for x in results) - (self.query.limit_dict.get('offset') or 0), 0)
+            limit = self.query.limit_dict.get('limit')
+            return select_count if limit is None else min(select_count, limit)
         sql, params = self.query.sql_expr(method='count')
-        (select_count,) = Database.execute(self.model.__db_label__, sql, params).fetchone()
+        (select_count,) = self._execute(db_labels[0], sql, params, fetch='one')
         return select_count
 
     # update
@@ -486,7 +1123,8 @@ class QuerySet(object):
         if kwargs:
             _, kwargs = ModelCheck(self.query).field_wash(fields_list=[], fields_dict=kwargs)
             sql, params = self.query.sql_expr(method='update', update_dict=kwargs)
-            Database.execute(self.model.__db_label__, sql, params)
+            self._shard_execute(self._shard_labels(), sql, params, fetch='none')
+            self._evict_session()
 
     # order_by函数，返回一个新的QuerySet对象
     def order_by(self, *args):
@@ -501,14 +1139,25 @@ class QuerySet(object):
         obj.save()
         return obj
 
-    # exists
+    # exists，使用 select 1 ... limit 1，已查询过时直接使用结果
     def exists(self):
-        return bool(self.first())
+        if self.select_result is not None:
+            return bool(self.select_result)
+        db_labels = self._shard_labels()
+        if len(db_labels) > 1:
+            if self.query.limit_dict.get('offset'):
+                return self.count() > 0
+            sql, params = self._shard_query().sql_expr(method='exists')
+            results = self._shard_execute(db_labels, sql, params, fetch='one')
+            return any(x is not None for x in results)
+        sql, params = self.query.sql_expr(method='exists')
+        return self._execute(db_labels[0], sql, params, fetch='one') is not None
 
     # delete
     def delete(self):
         sql, params = self.query.sql_expr(method='delete')
-        Database.execute(self.model.__db_label__, sql, params)
+        self._shard_execute(self._shard_labels(), sql, params, fetch='none')
+        self._evict_session()
 
     # values
     def values(self, *args):
@@ -526,6 +1175,59 @@ class QuerySet(object):
 
         return self._clone(ValuesListQuerySet, fields_list or None, flat)
 
+    # only，只查询指定字段（及主键），其余字段在访问时加载
+    def only(self, *fields):
+        fields = self._deferrable_fields(fields) + [self.model.__primary_key__, self.model._meta.shard_key]
+        clone = self._clone()
+        clone.query.deferred = frozenset(x for x in self.model._meta.field_list if x not in fields)
+        return clone
+
+    # defer，不查询指定字段，访问时加载
+    def defer(self, *fields):
+        fields = self._deferrable_fields(fields)
+        clone = self._clone()
+        clone.query.deferred = self.query.deferred | frozenset(fields)
+        return clone
+
+    def _deferrable_fields(self, fields):
+        primary_key = self.model.__primary_key__
+        if not primary_key:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        fields, _ = ModelCheck(self.query).field_wash(fields)
+        for field in fields:
+            if '__' in field:
+                raise TypeError('Cannot defer join field %s.' % field)
+        # 主键及分片键不延迟加载
+        return [x for x in fields if x not in (primary_key, self.model._meta.shard_key)]
+
+    # 查询结果后按 local_field 的值分批 in 查询关联模型，结果设置到对象的 alias 属性
+    # many=True 时为列表，否则为单个对象（不存在时为 None）
+    def prefetch(self, related_model, alias, local_field, remote_field, many=True, batch_size=1000):
+        if self.__class__ is not QuerySet:
+            raise TypeError('prefetch() is only valid for model querysets.')
+        related_query = related_model if isinstance(related_model, QuerySet) else related_model.objects.all()
+        local_name = self.model._meta.names.get(local_field)
+        remote_name = related_query.model._meta.names.get(remote_field)
+        if not local_name or not remote_name:
+            raise TypeError('Cannot resolve keyword %s into field.' % (remote_field if local_name else local_field))
+        if alias in self.model._meta.names or alias in self.query.join_as:
+            raise TypeError("alias '%s' is already exists" % alias)
+        clone = self._clone()
+        clone.query.prefetches.append((related_query, alias, local_name, remote_name, many, batch_size))
+        return clone
+
+    def _prefetch(self, objs):
+        for related_query, alias, local_name, remote_name, many, batch_size in self.query.prefetches:
+            keys = list({getattr(obj, local_name) for obj in objs} - {None})
+            related = {}
+            for index in range(0, len(keys), batch_size):
+                batch_query = related_query.filter(**{remote_name + '__in': keys[index:index + batch_size]})
+                for related_obj in batch_query:
+                    related.setdefault(getattr(related_obj, remote_name), []).append(related_obj)
+            for obj in objs:
+                value = related.get(getattr(obj, local_name), [])
+                obj._set_related(alias, value if many else (value[0] if value else None))
+
     # group_by
     def group_by(self, *args):
         fields_list, _ = ModelCheck(self.query).field_wash(args)
@@ -565,11 +1267,232 @@ class QuerySet(object):
             {'join_model': join_model, 'join_on': tuple(wash_kwargs.items())}
         return clone
 
+    # 流式迭代，使用服务端游标分批取数据，不缓存结果
+    def iterator(self, chunk_size=2000):
+        for rows in self._row_chunks(chunk_size):
+            yield from self._iterable_result(rows)
+
+    # 分批读取原始结果行
+    def _row_chunks(self, chunk_size):
+        if chunk_size <= 0:
+            raise TypeError('Chunk size must be strictly positive.')
+        if self.select_result is not None:
+            for index in range(0, len(self.select_result), chunk_size):
+                yield self.select_result[index:index + chunk_size]
+            return
+        db_labels = self._shard_labels()
+        if len(db_labels) > 1:
+            sql, params = self._shard_query().sql_expr()
+            streams = [chain.from_iterable(Database.stream(x, sql, params, chunk_size, read=not self._for_write))
+                       for x in db_labels]
+            rows = self._merge_shards(streams)
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    return
+                yield chunk
+        sql, params = self.query.sql_expr()
+        yield from Database.stream(db_labels[0], sql, params, chunk_size, read=not self._for_write)
+
+    # 列式读取，返回 {字段名: Column(values, mask)}，values 为 numpy 数组（未安装时为 array.array 或 list）
+    # dtypes 指定各字段的 dtype，未指定时按值推断（bool / int64 / float64，其它类型及 Decimal 为 object）；
+    # NULL 在 values 中填充 0（object 为 None）
+    def to_columns(self, *fields, dtypes=None, chunk_size=10000):
+        dtypes = dtypes or {}
+        qs = self.values(*fields)
+        select_field = qs.select_field
+        unknown = set(dtypes) - set(select_field)
+        if unknown:
+            raise TypeError('Unknown dtypes fields: %s' % ', '.join(sorted(unknown)))
+        buffers = [_ColumnBuffer(dtypes.get(x), chunk_size) for x in select_field]
+        for rows in qs._row_chunks(chunk_size):
+            for buffer, column in zip(buffers, zip(*rows)):
+                buffer.extend(column)
+        return {field: buffer.finish() for field, buffer in zip(select_field, buffers)}
+
+    # 同 to_columns，只返回 {字段名: values}
+    def values_arrays(self, *fields, dtypes=None, chunk_size=10000):
+        columns = self.to_columns(*fields, dtypes=dtypes, chunk_size=chunk_size)
+        return {field: column.values for field, column in columns.items()}
+
+    # 流式导出到文件路径或文件对象，format: csv / jsonl / parquet，返回导出行数
+    # 列名与 values() 相同；gzip 压缩输出（parquet 使用 gzip 列压缩）；progress(已导出行数) 每批调用一次
+    # schema 为 parquet 的 pyarrow.Schema，未指定时由数据推断
+    def export(self, path_or_fileobj, format='csv', chunk_size=10000, gzip=False, progress=None, schema=None):
+        if format not in ('csv', 'jsonl', 'parquet'):
+            raise TypeError('Unsupported export format: %s' % format)
+        qs = self.values()
+        select_field = qs.select_field
+        if format == 'parquet':
+            return qs._export_parquet(path_or_fileobj, select_field, chunk_size, gzip, progress, schema)
+
+        own_file = isinstance(path_or_fileobj, (str, bytes)) or hasattr(path_or_fileobj, '__fspath__')
+        if gzip and isinstance(path_or_fileobj, io.TextIOBase):
+            raise TypeError('gzip export requires a binary file object.')
+        raw = open(path_or_fileobj, 'wb') if own_file else path_or_fileobj
+        binary = GzipFile(fileobj=raw, mode='wb') if gzip else raw
+        if isinstance(binary, io.TextIOBase):
+            text = binary
+        else:
+            text = io.TextIOWrapper(binary, encoding='utf-8', newline='', write_through=False)
+        count = 0
+        try:
+            if format == 'csv':
+                writer = csv.writer(text)
+                writer.writerow(select_field)
+            for rows in qs._row_chunks(chunk_size):
+                if format == 'csv':
+                    writer.writerows(rows)
+                else:
+                    text.writelines(json.dumps(dict(zip(select_field, row)), ensure_ascii=False, default=str) + '\n'
+                                    for row in rows)
+                count += len(rows)
+                if progress is not None:
+                    progress(count)
+        finally:
+            text.flush()
+            if text is not binary:
+                # 不关闭调用方传入的文件对象
+                text.detach()
+            if binary is not raw:
+                binary.close()
+            if own_file:
+                raw.close()
+        return count
+
+    # 推断 schema 时，仍有列全部为 NULL（类型未知）则暂缓写入，直到类型确定或暂存行数达到 PARQUET_PENDING_ROWS；
+    # 暂存的各批 schema 合并提升（如 int64 -> double），decimal 放宽到最大精度
+    def _export_parquet(self, path_or_fileobj, select_field, chunk_size, gzip, progress, schema=None):
+        if pyarrow is None:
+            raise TypeError('pyarrow is required for parquet export.')
+        types = [schema.field(x).type for x in select_field] if schema is not None else [None] * len(select_field)
+        writer = None
+        pending = []
+        pending_rows = 0
+        count = 0
+        try:
+            for rows in self._row_chunks(chunk_size):
+                table = pyarrow.Table.from_arrays([self._parquet_array(x, t) for x, t in zip(zip(*rows), types)],
+                                                  names=select_field)
+                if writer is None:
+                    pending.append(table)
+                    pending_rows += len(rows)
+                    if schema is None or len(pending) > 1:
+                        schema = pyarrow.unify_schemas([x.schema for x in pending], promote_options='permissive')
+                    if any(pyarrow.types.is_null(x.type) for x in schema) and pending_rows < PARQUET_PENDING_ROWS:
+                        continue
+                    writer = pyarrow.parquet.ParquetWriter(path_or_fileobj, schema,
+                                                           compression='gzip' if gzip else 'snappy')
+                    tables, pending = pending, []
+                else:
+                    tables = [table]
+                count = self._write_parquet(writer, tables, count, progress)
+            if writer is None:
+                # 没有数据时同样写入只有列名的文件
+                if schema is None:
+                    schema = pyarrow.schema([(x, pyarrow.null()) for x in select_field])
+                writer = pyarrow.parquet.ParquetWriter(path_or_fileobj, schema,
+                                                       compression='gzip' if gzip else 'snappy')
+                count = self._write_parquet(writer, pending, count, progress)
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
+
+    # 推断出的 decimal 精度只取决于本批数据的位数，统一放宽到最大精度，只保留小数位数，避免后续批次位数更多时类型不一致
+    @staticmethod
+    def _parquet_array(values, type=None):
+        array = pyarrow.array(values, type=type)
+        if type is None and pyarrow.types.is_decimal(array.type):
+            array = array.cast(pyarrow.decimal128(38, array.type.scale))
+        return array
+
+    @staticmethod
+    def _write_parquet(writer, tables, count, progress):
+        for table in tables:
+            if not table.schema.equals(writer.schema):
+                try:
+                    table = table.cast(writer.schema)
+                except pyarrow.ArrowException:
+                    changed = ['%s: %s -> %s' % (x.name, x.type, y.type)
+                               for x, y in zip(writer.schema, table.schema) if x.type != y.type]
+                    raise TypeError('Parquet column types changed (%s), pass schema to export().'
+                                    % ', '.join(changed))
+            writer.write_table(table)
+            count += table.num_rows
+            if progress is not None:
+                progress(count)
+        return count
+
+    # 键集分页，按 key_fields 排序，使用上一页最后一行的键值作为条件代替 offset
+    # 返回 (结果列表, 下一页游标)，没有下一页时游标为 None
+    def paginate_by_key(self, key_fields=None, page_size=100, after=None):
+        if self.query.limit_dict:
+            raise TypeError('Cannot paginate a query once a slice has been taken.')
+        key_fields = self._pagination_keys(key_fields)
+        page_query = self.order_by(*key_fields)
+        if after is not None:
+            values = json.loads(base64.urlsafe_b64decode(after.encode()).decode())
+            if len(values) != len(key_fields):
+                raise TypeError('Invalid pagination cursor.')
+            page_query = page_query.filter(self._after_q(key_fields, values))
+
+        results = list(page_query[:page_size])
+        next_cursor = None
+        if len(results) == page_size:
+            values = [self._key_value(results[-1], x.lstrip('-')) for x in key_fields]
+            next_cursor = base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+        return results, next_cursor
+
+    # 按键集分页遍历全部结果
+    def iterate_by_key(self, key_fields=None, page_size=1000):
+        cursor = None
+        while True:
+            results, cursor = self.paginate_by_key(key_fields, page_size, cursor)
+            yield from results
+            if cursor is None:
+                break
+
+    def _pagination_keys(self, key_fields):
+        key_fields, _ = ModelCheck(self.query).field_wash(key_fields or self.query.order_fields)
+        primary_key = self.model.__primary_key__
+        if primary_key not in [x.lstrip('-') for x in key_fields]:
+            # 主键保证排序唯一
+            if not primary_key:
+                raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+            desc = key_fields and key_fields[-1][0] == '-'
+            key_fields.append(('-' if desc else '') + primary_key)
+        return key_fields
+
+    # (k1 > v1) or (k1 = v1 and k2 > v2) ...，降序字段使用 <
+    @staticmethod
+    def _after_q(key_fields, values):
+        after_q = None
+        for index, key in enumerate(key_fields):
+            equal = {key_fields[i].lstrip('-'): values[i] for i in range(index)}
+            lookup = key[1:] + '__lt' if key[0] == '-' else key + '__gt'
+            temp_q = Q(**dict(equal, **{lookup: values[index]}))
+            after_q = temp_q if after_q is None else after_q | temp_q
+        return after_q
+
+    # 取得结果中的键值
+    def _key_value(self, result, key):
+        if '__' in key:
+            table_as, field = key.split('__')
+            return getattr(getattr(result, table_as), field)
+        return getattr(result, key)
+
     # sql查询基础函数
     def select(self):
         if self.select_result is None:
+            db_labels = self._shard_labels()
+            if len(db_labels) > 1:
+                sql, params = self._shard_query().sql_expr()
+                results = self._shard_execute(db_labels, sql, params)
+                self.select_result = list(self._merge_shards(results))
+                return
             sql, params = self.query.sql_expr()
-            self.select_result = Database.execute(self.model.__db_label__, sql, params).fetchall()
+            self.select_result = self._execute(db_labels[0], sql, params)
 
     def base_index(self, index):
         if self.select_result is None:
@@ -582,8 +1505,15 @@ class QuerySet(object):
 
     # 索引值查询
     def get_index(self, index):
+        if index == 0 and self.select_result is None:
+            inst = self._from_session()
+            if inst is not None:
+                return inst
         index_value = self.base_index(index)
-        return self.data_to_obj(index_value)
+        inst = self.data_to_obj(index_value)
+        if self.query.prefetches:
+            self._prefetch([inst])
+        return inst
 
     def _clone(self, klass=None, select=None, flat=False):
         if klass is None:
@@ -593,9 +1523,134 @@ class QuerySet(object):
             query.select = list(select[:])
         if flat:
             query.flat = flat
+        if issubclass(klass, (ValuesQuerySet, ValuesListQuerySet)):
+            # values/values_list 不使用延迟加载及预取
+            query.deferred = frozenset()
+            query.prefetches = []
         obj = klass(model=self.model, query=query)
+        obj._db_label = self._db_label
+        obj._for_write = self._for_write
+        obj._cache = self._cache
+        obj._cache_ttl = self._cache_ttl
         return obj
 
+    # 返回唯一匹配的对象，使用 limit 2，没有或多于一个时抛出异常
+    def get(self, *args, **kwargs):
+        if not args and len(kwargs) == 1 and self._pk_sql_usable():
+            key, value = next(iter(kwargs.items()))
+            if self.model._meta.names.get(key) == self.model.__primary_key__:
+                return self._get_by_pk(value)
+        clone = self.filter(*args, **kwargs) if args or kwargs else self
+        results = list(clone[:2])
+        if not results:
+            raise ObjectDoesNotExist('%s matching query does not exist.' % self.model.__name__)
+        if len(results) > 1:
+            raise MultipleObjectsReturned('get() returned more than one %s.' % self.model.__name__)
+        return results[0]
+
+    # 使用预编译的主键查询sql，不经过通用编译
+    def _get_by_pk(self, pk):
+        session = self._session()
+        if session is not None:
+            inst = session.get(self.model, pk)
+            if inst is not None:
+                return inst
+        rows = self._execute(self.db_label, self.model._meta.pk_get_sql, (pk,))
+        if not rows:
+            raise ObjectDoesNotExist('%s matching query does not exist.' % self.model.__name__)
+        if len(rows) > 1:
+            raise MultipleObjectsReturned('get() returned more than one %s.' % self.model.__name__)
+        return self.data_to_obj(rows[0])
+
+    # 按主键批量查询，返回 {主键: 对象}，会话中已有的对象不再查询，每批一条 in 查询
+    def in_bulk(self, pks, batch_size=1000):
+        if not self.model.__primary_key__:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        if self.__class__ is not QuerySet:
+            raise TypeError('in_bulk() is only valid for model querysets.')
+        pks = list(OrderedDict.fromkeys(pks))
+        result = {}
+        session = self._session()
+        if session is not None and self._is_plain():
+            missing = []
+            for pk in pks:
+                inst = session.get(self.model, pk)
+                if inst is None:
+                    missing.append(pk)
+                else:
+                    result[pk] = inst
+            pks = missing
+        pk_sql_usable = self._pk_sql_usable()
+        convert = self._row_converter()
+        for index in range(0, len(pks), batch_size):
+            batch = pks[index:index + batch_size]
+            if pk_sql_usable:
+                objs = [convert(x) for x in
+                        self._execute(self.db_label, self.model._meta.pk_in_sql, (batch,))]
+            else:
+                objs = self.filter(pk__in=batch)
+            for obj in objs:
+                result[obj.pk] = obj
+        return result
+
+    # 可以使用预编译主键sql：模型查询，没有筛选条件、延迟加载、聚合等，且只涉及一个库
+    def _pk_sql_usable(self):
+        query = self.query
+        return (self.__class__ is QuerySet and self.model.__primary_key__ and self._is_plain()
+                and not (query.deferred or query.annotates or query.group_by or query.distinct)
+                and len(self._shard_labels()) == 1)
+
+    # 没有筛选条件、join、切片及预取的查询
+    # 当前会话，using() 指定其它库时不使用会话，避免不同库中相同主键的对象混用
+    def _session(self):
+        if self._db_label is not None and self._db_label != self.model.__db_label__:
+            return None
+        return _session.get()
+
+    def _is_plain(self):
+        query = self.query
+        return not (query.where.filter_Q or query.join_as or query.limit_dict or query.prefetches)
+
+    # 只按主键 = 查询时从会话中取得对象
+    def _from_session(self):
+        session = self._session()
+        if session is None or self.__class__ is not QuerySet:
+            return None
+        query = self.query
+        filter_q = query.where.filter_Q
+        if query.join_as or query.limit_dict.get('offset') or query.prefetches:
+            return None
+        if filter_q.negated or len(filter_q.children) != 1 or isinstance(filter_q.children[0], Q):
+            return None
+        key, value = filter_q.children[0]
+        if self.model._meta.names.get(key) != self.model.__primary_key__ or isinstance(value, Combinable):
+            return None
+        return session.get(self.model, value)
+
+    # update / delete 后从会话中移除受影响的对象，按主键筛选时只移除对应主键，否则移除该模型的全部对象
+    def _evict_session(self):
+        session = self._session()
+        if session is None:
+            return
+        session.evict(self.model, self._filter_pks())
+
+    # 只按主键 = 或 in 筛选时返回主键列表，否则返回 None
+    def _filter_pks(self):
+        filter_q = self.query.where.filter_Q
+        if self.query.join_as or filter_q.negated or len(filter_q.children) != 1 or \
+                isinstance(filter_q.children[0], Q):
+            return None
+        key, value = filter_q.children[0]
+        names = self.model._meta.names
+        if isinstance(value, Combinable):
+            return None
+        if names.get(key) == self.model.__primary_key__:
+            return [value]
+        if key.endswith('__in') and names.get(key[:-4]) == self.model.__primary_key__ and \
+                isinstance(value, (list, tuple, set, frozenset)):
+            return list(value)
+        return None
+
     # 根据传入的筛选条件，返回新的QuerySet对象
     def _filter_or_exclude(self, negate, *args, **kwargs):
         clone = self._clone()
@@ -653,26 +1708,118 @@ class QuerySet(object):
             return None
 
     def data_to_obj(self, value):
-        start_index = len(self.fields_list)
-        inst = self.model(**dict(zip(self.fields_list, value[:start_index])))
+        return self._row_converter()(value)
+
+    # 返回结果行转换函数，会话、延迟加载字段及 join 信息每批结果只解析一次
+    def _row_converter(self):
+        model = self.model
+        deferred = self.query.deferred
+        session = self._session()
+        if session is not None:
+            convert = session.loader(model, deferred)
+        elif deferred:
+            convert = partial(model.from_db, deferred=deferred)
+        else:
+            convert = model._meta.row_loader
+        if not self.query.join_as:
+            return convert
+        joins = []
+        start_index = field_count = len(model._meta.loaded_fields(deferred))
         for table_as, join_info in self.query.join_as.items():
             join_model = join_info['join_model']
-            temp_len = len(join_model.field_list)
-            temp_obj = join_model(**dict(zip(join_model.field_list, value[start_index:start_index + temp_len])))
-            setattr(inst, table_as, temp_obj)
-            start_index += temp_len
-        return inst
+            end_index = start_index + len(join_model._meta.field_list)
+            join_convert = join_model._meta.row_loader if session is None else session.loader(join_model)
+            joins.append((table_as, start_index, end_index, join_convert))
+            start_index = end_index
+
+        def convert_join(value):
+            inst = convert(value[:field_count])
+            for table_as, start, end, join_convert in joins:
+                inst._set_related(table_as, join_convert(value[start:end]))
+            return inst
+
+        return convert_join
+
+    # 将查询结果行转换为返回对象
+    def _iterable_result(self, rows):
+        if self.query.prefetches or Instrumentation.timing:
+            objs = self._hydrate(rows)
+            if self.query.prefetches:
+                self._prefetch(objs)
+            yield from objs
+            return
+        yield from map(self._row_converter(), rows)
+
+    def _hydrate(self, rows):
+        if not Instrumentation.timing:
+            return list(map(self._row_converter(), rows))
+        start = time.perf_counter()
+        objs = list(map(self._row_converter(), rows))
+        Instrumentation.record('hydrate', len(objs), time.perf_counter() - start)
+        return objs
 
     # 返回自定义迭代器
     def __iter__(self):
         self.select()
-        for value in self.select_result:
-            inst = self.data_to_obj(value)
-            yield inst
+        return self._iterable_result(self.select_result)
 
     def __bool__(self):
         return self.exists()
 
+    # 异步查询，使用 AsyncDatabase，返回结果列表
+    async def afetch(self):
+        if self.select_result is None:
+            sql, params = self.query.sql_expr()
+            self.select_result = await self._aexecute(sql, params)
+        if self.query.prefetches:
+            objs = self._hydrate(self.select_result)
+            await self._aprefetch(objs)
+            return objs
+        return list(self._iterable_result(self.select_result))
+
+    async def _aprefetch(self, objs):
+        for related_query, alias, local_name, remote_name, many, batch_size in self.query.prefetches:
+            keys = list({getattr(obj, local_name) for obj in objs} - {None})
+            related = {}
+            for index in range(0, len(keys), batch_size):
+                batch_query = related_query.filter(**{remote_name + '__in': keys[index:index + batch_size]})
+                for related_obj in await batch_query.afetch():
+                    related.setdefault(getattr(related_obj, remote_name), []).append(related_obj)
+            for obj in objs:
+                value = related.get(getattr(obj, local_name), [])
+                obj._set_related(alias, value if many else (value[0] if value else None))
+
+    async def __aiter__(self):
+        for obj in await self.afetch():
+            yield obj
+
+    async def acount(self):
+        if self.select_result is not None:
+            return len(self.select_result)
+        sql, params = self.query.sql_expr(method='count')
+        (select_count,) = await self._aexecute(sql, params, fetch='one')
+        return select_count
+
+    async def aexists(self):
+        if self.select_result is not None:
+            return bool(self.select_result)
+        sql, params = self.query.sql_expr(method='exists')
+        return await self._aexecute(sql, params, fetch='one') is not None
+
+    async def aupdate(self, **kwargs):
+        if kwargs:
+            _, kwargs = ModelCheck(self.query).field_wash(fields_list=[], fields_dict=kwargs)
+            sql, params = self.query.sql_expr(method='update', update_dict=kwargs)
+            await AsyncDatabase.execute(self.db_label, sql, params, fetch='none')
+            self.result_cache.invalidate(self.model._meta.table_info)
+            self._evict_session()
+
+    async def adelete(self):
+        sql, params = self.query.sql_expr(method='delete')
+        await AsyncDatabase.execute(self.db_label, sql, params, fetch='none')
+        self.result_cache.invalidate(self.model._meta.table_info)
+        self._evict_session()
+
     def __repr__(self):
         return '<QuerySet Obj>'
 
@@ -686,16 +1833,23 @@ class ValuesQuerySet(QuerySet):
             for table_as, join_info in self.query.join_as.items():
                 self.select_field.extend(table_as + '__' + x for x in join_info['join_model'].field_list)
 
-    def __iter__(self):
-        self.select()
-        for value in self.select_result:
-            inst = {field: value[index] for index, field in enumerate(self.select_field)}
-            yield inst
+    def _iterable_result(self, rows):
+        select_field = self.select_field
+        for value in rows:
+            yield dict(zip(select_field, value))
 
     def get_index(self, index):
         index_value = self.base_index(index)
         return {field: index_value[f_index] for f_index, field in enumerate(self.select_field)}
 
+    def _row_fields(self):
+        return self.select_field
+
+    def _key_value(self, result, key):
+        if key not in result:
+            raise TypeError('Pagination key %s must be in values().' % key)
+        return result[key]
+
     def __repr__(self):
         return '<ValuesQuerySet Obj>'
 
@@ -708,13 +1862,12 @@ class ValuesListQuerySet(QuerySet):
         if self.flat and len(self.select_field) != 1:
             raise TypeError('flat is not valid when values_list is called with more than one field.')
 
-    def __iter__(self):
-        self.select()
-        for value in self.select_result:
-            if self.flat:
+    def _iterable_result(self, rows):
+        if self.flat:
+            for value in rows:
                 yield value[0]
-            else:
-                yield value
+        else:
+            yield from rows
 
     def get_index(self, index):
         index_value = self.base_index(index)
@@ -723,6 +1876,14 @@ class ValuesListQuerySet(QuerySet):
         else:
             return index_value
 
+    def _row_fields(self):
+        return self.select_field
+
+    def _key_value(self, result, key):
+        if key not in self.select_field:
+            raise TypeError('Pagination key %s must be in values_list().' % key)
+        return result if self.flat else result[self.select_field.index(key)]
+
     def __repr__(self):
         return '<ValuesListQuerySet Obj>'
 
@@ -746,10 +1907,10 @@ class ModelCheck:
                 join_as, temp_model = temp_as + '__', self.join_as[temp_as]['join_model']
             else:
                 join_as, temp_model = '', self.model
-            field_obj = temp_model.attrs.get(field, None)
-            if not field_obj and field not in self.annotates:
+            field_name = temp_model._meta.names.get(field)
+            if not field_name and field not in self.annotates:
                 raise TypeError('Cannot resolve keyword %s into field.' % field)
-            temp_list.append(minus + join_as + getattr(field_obj, 'name', field))
+            temp_list.append(minus + join_as + (field_name or field))
 
         temp_dict = {}
         if fields_dict:
@@ -759,10 +1920,10 @@ class ModelCheck:
                     join_as, temp_model = temp_as + '__', self.join_as[temp_as]['join_model']
                 else:
                     join_as, temp_model = '', self.model
-                field_obj = temp_model.attrs.get(key, None)
-                if not field_obj:
+                field_name = temp_model._meta.names.get(key)
+                if not field_name:
                     raise TypeError('Cannot resolve keyword %s into field.' % key)
-                temp_dict[join_as + field_obj.name] = value
+                temp_dict[join_as + field_name] = value
         return temp_list, temp_dict
 
     def field_info(self, field_name):
@@ -816,16 +1977,581 @@ class Manager:
     def values_list(self, *args, **kwargs):
         return self.get_queryset().values_list(*args, **kwargs)
 
-    def bulk_create(self, objs, ignore_conflicts=False):
-        fields = self.model.field_list
-        items = [[getattr(obj, field, None) for field in fields] for obj in objs]
-        obj_value = ', '.join(['%s'] * len(fields))
-        insert = 'insert %s into %s(%s) values(%s);' % ('ignore' if ignore_conflicts else '', self.model.table_info(),
-                                                        ', '.join(self.model.field_info(x) for x in fields), obj_value)
-        Database.executemany(self.model.__db_label__, insert, items)
+    def iterator(self, chunk_size=2000):
+        return self.get_queryset().iterator(chunk_size=chunk_size)
+
+    def paginate_by_key(self, key_fields=None, page_size=100, after=None):
+        return self.get_queryset().paginate_by_key(key_fields, page_size, after)
+
+    def iterate_by_key(self, key_fields=None, page_size=1000):
+        return self.get_queryset().iterate_by_key(key_fields, page_size)
+
+    def to_columns(self, *fields, **kwargs):
+        return self.get_queryset().to_columns(*fields, **kwargs)
+
+    def values_arrays(self, *fields, **kwargs):
+        return self.get_queryset().values_arrays(*fields, **kwargs)
+
+    def export(self, *args, **kwargs):
+        return self.get_queryset().export(*args, **kwargs)
+
+    def only(self, *fields):
+        return self.get_queryset().only(*fields)
+
+    def prefetch(self, *args, **kwargs):
+        return self.get_queryset().prefetch(*args, **kwargs)
+
+    def defer(self, *fields):
+        return self.get_queryset().defer(*fields)
+
+    def get(self, *args, **kwargs):
+        return self.get_queryset().get(*args, **kwargs)
+
+    def in_bulk(self, pks, batch_size=1000):
+        return self.get_queryset().in_bulk(pks, batch_size)
+
+    def using(self, db_label):
+        return self.get_queryset().using(db_label)
+
+    def primary(self):
+        return self.get_queryset().primary()
+
+    def cache(self, ttl=None):
+        return self.get_queryset().cache(ttl)
+
+    # 批量插入，按 batch_size 及数据包大小分批，每批一条多行 insert 语句
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False, return_pks=False):
+        insert = self._bulk_create_sql(ignore_conflicts, return_pks)
+        return self._bulk_insert(objs, batch_size, insert, '', return_pks)
+
+    # 异步批量插入，使用 AsyncDatabase
+    async def abulk_create(self, objs, batch_size=None, ignore_conflicts=False, return_pks=False):
+        insert = self._bulk_create_sql(ignore_conflicts, return_pks)
+        rowcount = 0
+        for db_label, shard_objs in self._shard_groups(objs):
+            for batch, sql, params in self._insert_batches(shard_objs, batch_size, insert, '', return_pks):
+                result = await AsyncDatabase.execute(db_label, sql, params, fetch='none')
+                rowcount += result.rowcount
+                if return_pks:
+                    step = await self._ainsert_step(db_label)
+                    self._set_pks(batch, self.model._meta.backend.first_insert_id(result.lastrowid, len(batch), step),
+                                  step)
+        QuerySet.result_cache.invalidate(self.model._meta.table_info)
+        return rowcount
+
+    def _bulk_create_sql(self, ignore_conflicts, return_pks):
+        meta = self.model._meta
+        if return_pks and (ignore_conflicts or not meta.primary_key):
+            raise TypeError('return_pks requires a primary key and is not valid with ignore_conflicts.')
+        return '%s %s(%s) values ' % (meta.backend.insert_ignore if ignore_conflicts else 'insert into',
+                                      meta.table_info, ', '.join(meta.insert_columns))
+
+    # 批量 insert ... on duplicate key update，主键或唯一键冲突时更新 update_fields
+    def bulk_upsert(self, objs, update_fields=None, batch_size=None):
+        meta = self.model._meta
+        suffix = self._upsert_sql(update_fields)
+        insert = 'insert into %s(%s) values ' % (meta.table_info, ', '.join(meta.insert_columns))
+        return self._bulk_insert(objs, batch_size, insert, suffix)
+
+    # auto_pk 为 True 时主键由数据库生成，冲突更新时通过 LAST_INSERT_ID 返回已存在行的主键
+    def _upsert_sql(self, update_fields=None, auto_pk=False):
+        meta = self.model._meta
+        if update_fields is None:
+            update_fields = [x for x in meta.field_list if x != meta.primary_key]
+        else:
+            update_fields, _ = ModelCheck(self.get_queryset().query).field_wash(update_fields)
+        columns = ['`%s`' % meta.db_columns[x] for x in update_fields]
+        pk_column = '`%s`' % meta.db_columns[meta.primary_key] if meta.primary_key and auto_pk else None
+        return meta.backend.upsert_sql(columns, pk_column)
+
+    def _bulk_insert(self, objs, batch_size, insert, suffix, return_pks=False):
+        rowcount = 0
+        for db_label, shard_objs in self._shard_groups(objs):
+            for batch, sql, params in self._insert_batches(shard_objs, batch_size, insert, suffix, return_pks):
+                result = Database.execute(db_label, sql, params, fetch='none')
+                rowcount += result.rowcount
+                if return_pks:
+                    step = self._insert_step(db_label)
+                    self._set_pks(batch, self.model._meta.backend.first_insert_id(result.lastrowid, len(batch), step),
+                                  step)
+        QuerySet.result_cache.invalidate(self.model._meta.table_info)
+        return rowcount
+
+    # 按对象所在数据库分组，返回 [(db_label, 对象列表)]
+    def _shard_groups(self, objs):
+        if not self.model._meta.shards:
+            return [(self.model.__db_label__, objs)]
+        groups = OrderedDict()
+        for obj in objs:
+            groups.setdefault(obj._write_label(), []).append(obj)
+        return list(groups.items())
+
+    # 返回 (对象列表, sql, 参数) 的分批多行 insert 语句
+    def _insert_batches(self, objs, batch_size, insert, suffix, return_pks=False):
+        row_sql = '(%s)' % ', '.join(['%s'] * len(self.model._meta.field_list))
+        for batch, params in self._batches(objs, batch_size, len(insert) + len(suffix)):
+            if return_pks and any(obj.pk is not None for obj in batch):
+                raise TypeError('return_pks cannot be used with objects that already have a primary key.')
+            yield batch, insert + ', '.join([row_sql] * len(batch)) + suffix + ';', params
+
+    # 自增步长，可在数据库配置中通过 auto_increment_increment 指定，否则每个库查询一次
+    def _insert_step(self, db_label):
+        backend = Database.get_backend(db_label)
+        step = backend.auto_increment_steps.get(db_label)
+        if step is None:
+            step = Database.db_config.get(db_label, {}).get('auto_increment_increment')
+            if step is None and backend.auto_increment_sql:
+                step = Database.execute(db_label, backend.auto_increment_sql, fetch='one')[0]
+            step = backend.auto_increment_steps[db_label] = int(step or 1)
+        return step
+
+    async def _ainsert_step(self, db_label):
+        backend = Database.get_backend(db_label)
+        step = backend.auto_increment_steps.get(db_label)
+        if step is None:
+            step = Database.db_config.get(db_label, {}).get('auto_increment_increment')
+            if step is None and backend.auto_increment_sql:
+                step = (await AsyncDatabase.execute(db_label, backend.auto_increment_sql, fetch='one'))[0]
+            step = backend.auto_increment_steps[db_label] = int(step or 1)
+        return step
+
+    # 单条多行 insert 生成的自增主键连续，按自增步长递增，first_id 为第一行的主键
+    @staticmethod
+    def _set_pks(batch, first_id, step=1):
+        for index, obj in enumerate(batch):
+            obj.pk = first_id + index * step
+            obj._snapshot()
+            _session_add(obj)
+
+    # 批量更新，每批一条 update ... set col = case pk when ... end where pk in (...)
+    def bulk_update(self, objs, fields, batch_size=1000):
+        primary_key = self.model.__primary_key__
+        if not primary_key:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        fields, _ = ModelCheck(self.get_queryset().query).field_wash(fields)
+        if not fields:
+            raise TypeError('Field names must be given to bulk_update().')
+        if primary_key in fields or self.model._meta.shard_key in fields:
+            raise TypeError('bulk_update() cannot be used with primary key or shard key fields.')
+
+        rowcount = 0
+        # 每行在各字段的 case when 中及 in 条件中各绑定一次主键
+        key_count = len(fields) + 1
+        row_fields = [primary_key] * key_count + fields
+        row_len = len(row_fields)
+        # 每行每个字段的 ' when %s then %s' 及 in 条件中的 ', '
+        row_sql = 16 * len(fields) + 2
+        for db_label, shard_objs in self._shard_groups(objs):
+            for batch, params in self._batches(shard_objs, batch_size, fields=row_fields, row_sql=row_sql):
+                rows = [params[i:i + row_len] for i in range(0, len(params), row_len)]
+                if any(row[0] is None for row in rows):
+                    raise TypeError('All bulk_update() objects must have a primary key set.')
+                update_dict = {}
+                for index, field in enumerate(fields, key_count):
+                    update_dict[field] = Case('pk', [(row[0], row[index]) for row in rows], default=F(field))
+                query = self.filter(pk__in=[row[0] for row in rows]).query
+                sql, params = query.sql_expr(method='update', update_dict=update_dict)
+                rowcount += Database.execute(db_label, sql, params, fetch='none').rowcount
+                for obj in batch:
+                    obj._snapshot_fields(fields)
+        QuerySet.result_cache.invalidate(self.model._meta.table_info)
+        return rowcount
+
+    # 按数量及数据包字节数拆分对象，返回 (对象列表, 展开后的参数列表)
+    # fields 为每行绑定的参数对应的字段，可重复；row_sql 为每行除参数外的 sql 长度
+    def _batches(self, objs, batch_size=None, sql_size=0, fields=None, row_sql=0):
+        fields = fields or self.model._meta.field_list
+        max_params = self.model._meta.backend.max_params
+        if max_params:
+            batch_size = min(batch_size or max_params, max_params // len(fields))
+        max_size = self.model.db_info('max_allowed_packet') or MAX_ALLOWED_PACKET
+        # 预留部分空间给语句其余部分及转义
+        max_size = max_size * 0.9 - sql_size
+        objs = iter(objs)
+        while True:
+            batch = []
+            params = []
+            size = 0
+            for obj in islice(objs, batch_size):
+                values = [getattr(obj, field, None) for field in fields]
+                row_size = sum(_value_size(x) for x in values) + 4 * len(values) + row_sql
+                if batch and size + row_size > max_size:
+                    yield batch, params
+                    batch, params, size = [], [], 0
+                batch.append(obj)
+                params.extend(values)
+                size += row_size
+            if not batch:
+                return
+            yield batch, params
+
+
+# 生成由数据库行构建实例的函数，一条序列解包语句为全部字段赋值，同时适用于普通模型及 slots 模型
+def _make_row_loader(model, field_list):
+    if not field_list:
+        return None
+    source = ('def row_loader(row):\n'
+              '    inst = new(model)\n'
+              '    %s, = row\n'
+              '    inst._original = row\n'
+              '    return inst\n') % ', '.join('inst.' + x for x in field_list)
+    namespace = {'new': model.__new__, 'model': model}
+    exec(source, namespace)
+    return namespace['row_loader']
+
+
+# 模型元数据，类创建时预先计算字段名、列名等信息
+class Options:
+    registry = weakref.WeakSet()
+
+    def __init__(self, model, field_list, primary_key, meta_attrs=None):
+        self.model_name = model.__name__
+        self.db_table = model.__db_table__
+        self.db_label = model.__db_label__
+        self.field_list = tuple(field_list)
+        self.primary_key = primary_key
+        # 分片：Meta.shards 为各分片的库标签，Meta.shard_key 为分片字段，
+        # Meta.shard_func 根据分片字段值返回库标签，默认按 crc32 取模
+        self.shards = tuple(getattr(meta_attrs, 'shards', ()))
+        self.shard_key = getattr(meta_attrs, 'shard_key', None) if self.shards else None
+        self.shard_func = getattr(meta_attrs, 'shard_func', None)
+        if self.shards and self.shard_key not in field_list:
+            raise TypeError('Shard key %s must be a field of class: %s' % (self.shard_key, self.model_name))
+
+        names = {}
+        db_columns = {}
+        for key in field_list:
+            field = model.attrs[key]
+            names[key] = key
+            db_columns[key] = field.db_column or key
+        if primary_key:
+            names['pk'] = primary_key
+            db_columns['pk'] = db_columns[primary_key]
+        # 字段名（含 pk）-> 字段名
+        self.names = MappingProxyType(names)
+        # 字段名（含 pk）-> 列名
+        self.db_columns = MappingProxyType(db_columns)
+        # 列名 -> 字段名
+        self.attnames = MappingProxyType({db_columns[key]: key for key in field_list})
+        # 字段名（含 pk）-> `表名`.`列名`
+        self.columns = MappingProxyType(
+            {key: '`%s`.`%s`' % (self.db_table, column) for key, column in db_columns.items()})
+        self.column_list = tuple(self.columns[key] for key in field_list)
+        # insert 使用不带表名的列名
+        self.insert_columns = tuple('`%s`' % db_columns[key] for key in field_list)
+        # Meta.slots 模型实例没有 __dict__
+        self.slots = not model.__dictoffset__
+        self.row_loader = _make_row_loader(model, field_list)
+        self._loaded_fields = {}
+        self._table_info = None
+        self._pk_get_sql = None
+        self._pk_in_sql = None
+        self._backend = None
+        self.registry.add(self)
+
+    # 数据库方言，依赖数据库配置，Database.connect 时失效
+    @property
+    def backend(self):
+        backend = self._backend
+        if backend is None:
+            backend = self._backend = Database.get_backend(self.db_label)
+        return backend
+
+    # `库名`.`表名`，依赖数据库配置，Database.connect 时失效
+    @property
+    def table_info(self):
+        table_info = self._table_info
+        if table_info is None:
+            # 各分片库名可能不同，分片模型不带库名
+            database = None if self.shards else Database.db_config.get(self.db_label, {}).get('database')
+            table_info = self.backend.table_name(database, self.db_table)
+            self._table_info = table_info
+        return table_info
+
+    # 预编译的主键查询sql，get(pk=...) 与 in_bulk 使用
+    @property
+    def pk_get_sql(self):
+        if self._pk_get_sql is None:
+            self._pk_get_sql = 'select %s from %s where %s = %%s limit 2;' % (
+                ', '.join(self.column_list), self.table_info, self.columns[self.primary_key])
+        return self._pk_get_sql
+
+    @property
+    def pk_in_sql(self):
+        if self._pk_in_sql is None:
+            self._pk_in_sql = 'select %s from %s where %s in %%s;' % (
+                ', '.join(self.column_list), self.table_info, self.columns[self.primary_key])
+        return self._pk_in_sql
+
+    def shard_for(self, value):
+        if self.shard_func is not None:
+            return self.shard_func(value)
+        return self.shards[zlib.crc32(str(value).encode('utf8')) % len(self.shards)]
+
+    # 除延迟加载字段外的字段
+    def loaded_fields(self, deferred):
+        if not deferred:
+            return self.field_list
+        fields = self._loaded_fields.get(deferred)
+        if fields is None:
+            fields = self._loaded_fields[deferred] = tuple(x for x in self.field_list if x not in deferred)
+        return fields
+
+    @classmethod
+    def expire(cls, db_label):
+        for meta in list(cls.registry):
+            if meta.db_label == db_label:
+                meta._table_info = meta._pk_get_sql = meta._pk_in_sql = meta._backend = None
+
+
+# MySQL max_allowed_packet 默认值，可在数据库配置中通过 max_allowed_packet 修改
+MAX_ALLOWED_PACKET = 4 * 1024 * 1024
+
+# 导出 parquet 推断 schema 时最多暂存的行数
+PARQUET_PENDING_ROWS = 100000
+
+
+# 身份映射会话，上下文中同一 (模型, 主键) 只对应一个对象
+# 按主键查询时直接返回会话中的对象，查询结果中已存在的对象复用，不覆盖其字段值
+class Session:
+    def __init__(self):
+        self.identity_map = {}
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_session.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _session.reset(self._tokens.pop())
+
+    # 各分片的自增主键可能重复，分片模型不使用身份映射
+    def get(self, model, pk):
+        if model._meta.shards:
+            return None
+        return self.identity_map.get((model, pk))
+
+    def add(self, obj):
+        pk = obj.pk
+        if pk is not None and not obj._meta.shards:
+            self.identity_map.setdefault((obj.__class__, pk), obj)
+
+    # 移除模型中指定主键的对象，pks 为 None 时移除该模型的全部对象
+    def evict(self, model, pks=None):
+        identity_map = self.identity_map
+        if pks is None:
+            for key in [x for x in identity_map if x[0] is model]:
+                del identity_map[key]
+        else:
+            for pk in pks:
+                identity_map.pop((model, pk), None)
+
+    def clear(self):
+        self.identity_map.clear()
+
+    def load(self, model, row, deferred=None):
+        return self.loader(model, deferred)(row)
+
+    # 返回结果行转换函数，主键位置只计算一次
+    def loader(self, model, deferred=None):
+        from_db = partial(model.from_db, deferred=deferred) if deferred else model._meta.row_loader
+        primary_key = model.__primary_key__
+        if not primary_key or model._meta.shards:
+            return from_db
+        pk_index = model._meta.loaded_fields(deferred).index(primary_key)
+        identity_map = self.identity_map
+
+        def load(row):
+            key = (model, row[pk_index])
+            inst = identity_map.get(key)
+            if inst is None:
+                inst = identity_map[key] = from_db(row)
+            return inst
+
+        return load
+
+
+_session = contextvars.ContextVar('session', default=None)
+
+
+def _session_add(obj):
+    session = _session.get()
+    if session is not None:
+        session.add(obj)
+
+
+# 估算缓存结果占用的字节数
+def _result_size(value):
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value) + sum(_result_size(x) for x in value)
+    return _value_size(value)
+
+
+# 将参数转换为可哈希的缓存键
+def _freeze(params):
+    return tuple(tuple(x) if isinstance(x, (list, set, frozenset)) else x for x in params or ())
+
+
+# 估算参数转义后在sql中的字节数
+def _value_size(value):
+    if value is None:
+        return 4
+    if isinstance(value, str):
+        return len(value.encode('utf8')) * 2 + 2
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) * 2 + 10
+    return len(str(value)) + 2
+
+
+# 列式结果，mask 中 True 表示该行为 NULL
+Column = namedtuple('Column', ['values', 'mask'])
+
+# 未安装 numpy 时 dtype 对应的 array.array 类型码，其它 dtype 使用 list
+_ARRAY_TYPECODES = {
+    'bool': 'b', 'int8': 'b', 'uint8': 'B', 'int16': 'h', 'uint16': 'H', 'int32': 'i', 'uint32': 'I',
+    'int64': 'q', 'uint64': 'Q', 'float32': 'f', 'float64': 'd',
+}
+
+# 推断的 dtype 按顺序提升，Decimal 等其它类型使用 object，不损失精度
+_INFERRED_DTYPES = ('bool', 'int64', 'float64', 'object')
+_TYPE_RANKS = {bool: 0, int: 1, float: 2, type(None): -1}
+
+
+# 一批值需要的 dtype 序号，全部为 NULL 时为 -1
+def _dtype_rank(column):
+    return max(_TYPE_RANKS.get(x, 3) for x in set(map(type, column)))
+
+
+# 可增长的列缓冲区，容量不足时按倍数扩容，结束时截断到实际行数
+# 未指定 dtype 时每批推断，出现更宽的类型时提升已有数据的 dtype
+class _ColumnBuffer:
+    def __init__(self, dtype=None, capacity=1024):
+        self.dtype = dtype
+        self.inferred = dtype is None
+        self.rank = -1
+        self.capacity = capacity
+        self.size = 0
+        # 推断出 dtype 之前的连续 NULL 行数
+        self.pending = 0
+        self.values = self.mask = None
+        if dtype is not None:
+            self._allocate()
+
+    def _allocate(self):
+        dtype = self.dtype
+        if numpy is not None:
+            self.values = numpy.empty(self.capacity, dtype=dtype)
+            self.mask = numpy.zeros(self.capacity, dtype=bool)
+        else:
+            self.values = self._array(dtype)
+            self.mask = array.array('b')
+        self.fill = None if self._is_object() else 0
+        if self.pending:
+            pending, self.pending = self.pending, 0
+            self.extend((None,) * pending)
+
+    @staticmethod
+    def _array(dtype, values=()):
+        if not isinstance(dtype, str) or (dtype not in _ARRAY_TYPECODES and dtype != 'object'):
+            raise TypeError('Unsupported dtype %r without numpy.' % (dtype,))
+        typecode = _ARRAY_TYPECODES.get(dtype)
+        return array.array(typecode, values) if typecode else list(values)
+
+    def _is_object(self):
+        if numpy is not None:
+            return self.values.dtype == object
+        return isinstance(self.values, list)
+
+    # 提升已有数据的 dtype，转为 object 时已有的 NULL 填充 None
+    def _promote(self, rank):
+        self.rank = rank
+        self.dtype = _INFERRED_DTYPES[rank]
+        if numpy is not None:
+            self.values = self.values.astype(self.dtype)
+        else:
+            self.values = self._array(self.dtype, self.values)
+        if self._is_object():
+            self.fill = None
+            for index in range(self.size):
+                if self.mask[index]:
+                    self.values[index] = None
+
+    def _reserve(self, count):
+        need = self.size + count
+        if need <= self.capacity:
+            return
+        while self.capacity < need:
+            self.capacity *= 2
+        self.values.resize(self.capacity, refcheck=False)
+        self.mask.resize(self.capacity, refcheck=False)
+
+    def extend(self, column):
+        if self.inferred:
+            rank = _dtype_rank(column)
+            if self.values is None:
+                if rank < 0:
+                    self.pending += len(column)
+                    return
+                self.rank = rank
+                self.dtype = _INFERRED_DTYPES[rank]
+                self._allocate()
+            elif rank > self.rank:
+                self._promote(rank)
+        count = len(column)
+        nulls = None
+        if None in column:
+            nulls = [x is None for x in column]
+            fill = self.fill
+            column = [fill if x is None else x for x in column]
+        if numpy is not None:
+            self._reserve(count)
+            start, self.size = self.size, self.size + count
+            self.values[start:self.size] = column
+            if nulls is not None:
+                self.mask[start:self.size] = nulls
+        else:
+            self.size += count
+            self.values.extend(column)
+            if nulls is not None:
+                self.mask.extend(nulls)
+            else:
+                self.mask.frombytes(bytes(count))
+
+    def finish(self):
+        if self.values is None:
+            # 全部为 NULL
+            self.dtype = 'object'
+            self._allocate()
+        if numpy is not None:
+            self.values.resize(self.size, refcheck=False)
+            self.mask.resize(self.size, refcheck=False)
+        return Column(self.values, self.mask)
 
 
 class MetaModel(type):
+    def __new__(mcs, name, bases, attrs):
+        meta_attrs = attrs.get('Meta')
+        if name == 'Model' or '__slots__' in attrs:
+            pass
+        elif getattr(meta_attrs, 'abstract', False):
+            # 抽象类不保存实例属性，子类才能使用 __slots__
+            attrs = dict(attrs, __slots__=())
+        elif getattr(meta_attrs, 'slots', False):
+            declared_fields = {}
+            base_slots = set()
+            for base in bases[::-1]:
+                for klass in base.mro()[::-1]:
+                    declared_fields.update((k, v) for k, v in klass.__dict__.items() if isinstance(v, Field))
+                    declared_fields.update(klass.__dict__.get('_declared_fields', {}))
+                    base_slots.update(klass.__dict__.get('__slots__', ()))
+            declared_fields.update((k, v) for k, v in attrs.items() if isinstance(v, Field))
+            # 字段不能与同名 slot 同时作为类属性
+            attrs = {k: v for k, v in attrs.items() if not isinstance(v, Field)}
+            attrs['_declared_fields'] = declared_fields
+            attrs['__slots__'] = tuple(
+                k for k in list(declared_fields) + ['_related', '_original', '_deferred'] if k not in base_slots)
+        return super(MetaModel, mcs).__new__(mcs, name, bases, attrs)
+
     def __init__(cls, name, bases, attrs):
         super(MetaModel, cls).__init__(name, bases, attrs)
         if name == 'Model':
@@ -835,7 +2561,8 @@ class MetaModel(type):
         if meta_attrs and getattr(meta_attrs, 'abstract', False):
             return
         cls.__db_table__ = getattr(meta_attrs, 'db_table', name)
-        cls.__db_label__ = getattr(meta_attrs, 'db_label', 'default')
+        shards = getattr(meta_attrs, 'shards', None)
+        cls.__db_label__ = getattr(meta_attrs, 'db_label', shards[0] if shards else 'default')
 
         field_list = []
         primary_key = None
@@ -843,6 +2570,8 @@ class MetaModel(type):
         mro_list = cls.mro()[:-2]
         for base in mro_list[::-1]:
             attr_dict.update(base.__dict__)
+            attr_dict.update(base.__dict__.get('_declared_fields', {}))
+        slot_fields = cls.__dict__.get('_declared_fields', {})
         for key, val in attr_dict.items():
             if isinstance(val, Field):
                 val.name = key
@@ -852,15 +2581,18 @@ class MetaModel(type):
                     primary_key = key
                     attrs['pk'] = val
                 attrs[key] = val
-                setattr(cls, key, val)
+                if key not in slot_fields:
+                    setattr(cls, key, val)
                 field_list.append(key)
         cls.field_list = field_list
         cls.attrs = attrs
         cls.objects = Manager(cls)
         cls.__primary_key__ = primary_key
+        cls._meta = Options(cls, field_list, primary_key, meta_attrs)
 
 
 class Model(metaclass=MetaModel):
+    __slots__ = ()
 
     def __init__(self, **kw):
         [setattr(self, k, None) for k in self.field_list]
@@ -886,52 +2618,242 @@ class Model(metaclass=MetaModel):
 
     pk = property(_get_pk_val, _set_pk_val)
 
+    # 由数据库行直接构建实例，跳过关键字参数校验；保存原始行用于 save 时比较修改的字段
+    @classmethod
+    def from_db(cls, row, deferred=None):
+        meta = cls._meta
+        if not deferred:
+            return meta.row_loader(row)
+        inst = cls.__new__(cls)
+        for key, value in zip(meta.loaded_fields(deferred), row):
+            setattr(inst, key, value)
+        inst._original = row
+        inst._deferred = deferred
+        return inst
+
+    # 已加载的字段（不含延迟加载字段）
+    def _loaded_fields(self):
+        return self._meta.loaded_fields(getattr(self, '_deferred', None))
+
+    # 记录当前已加载字段的值，视为与数据库一致
+    def _snapshot(self):
+        self._original = tuple(getattr(self, x) for x in self._loaded_fields())
+
+    # 与原始值比较，返回修改过的字段
+    def _changed_fields(self):
+        loaded_fields = self._loaded_fields()
+        values = [getattr(self, x) for x in loaded_fields]
+        return {k: v for k, v, o in zip(loaded_fields, values, self._original) if v != o}
+
+    # 从数据库重新加载字段，默认加载全部字段
+    def refresh_from_db(self, fields=None):
+        meta = self._meta
+        if not meta.primary_key or self.pk is None:
+            raise TypeError('Cannot refresh an object without primary key.')
+        if fields is None:
+            fields = meta.field_list
+        else:
+            fields, _ = ModelCheck(self.objects.get_queryset().query).field_wash(fields)
+        row = self._pk_query().values_list(*fields).first()
+        if row is None:
+            raise ObjectDoesNotExist('%s matching query does not exist.' % self.__class__.__name__)
+
+        original = getattr(self, '_original', None)
+        values = dict(zip(self._loaded_fields(), original)) if original is not None else {}
+        values.update(zip(fields, row))
+        for key, value in zip(fields, row):
+            setattr(self, key, value)
+        deferred = getattr(self, '_deferred', None)
+        if deferred:
+            self._deferred = deferred.difference(fields)
+        if original is not None:
+            self._original = tuple(values[x] for x in self._loaded_fields())
+
+    # 设置join对象，slots 模型没有 __dict__，保存在 _related 中
+    def _set_related(self, name, obj):
+        if not self._meta.slots:
+            setattr(self, name, obj)
+            return
+        try:
+            self._related[name] = obj
+        except AttributeError:
+            self._related = {name: obj}
+
+    def __getattr__(self, name):
+        if name[0] != '_':
+            # 延迟加载字段，访问时单独查询
+            deferred = getattr(self, '_deferred', None)
+            if deferred and name in deferred:
+                self.refresh_from_db(fields=[name])
+                return getattr(self, name)
+            try:
+                return self._related[name]
+            except (AttributeError, KeyError):
+                pass
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    def _field_values(self):
+        deferred = getattr(self, '_deferred', None)
+        if deferred:
+            # 一次查询加载全部延迟字段
+            self.refresh_from_db(fields=deferred)
+        return [getattr(self, x) for x in self._meta.field_list]
+
     def __repr__(self):
         return '<%s obj>' % self.__class__.__name__
 
     def __bool__(self):
-        return bool(self.__dict__)
+        return bool(self.field_list)
 
     def __eq__(self, obj):
-        return self.__class__ == obj.__class__ and self.__dict__ == obj.__dict__
+        return self.__class__ == obj.__class__ and self._field_values() == obj._field_values()
 
     def __hash__(self):
-        return str(self.__dict__.__hash__) + str(self.__class__)
+        return hash((self.__class__, self.pk))
+
+    # 写操作使用的数据库，分片模型按分片键取得所在分片
+    def _write_label(self):
+        meta = self._meta
+        if not meta.shards:
+            return self.__db_label__
+        value = getattr(self, meta.shard_key)
+        if value is None:
+            raise TypeError('Shard key %s must be set on %s.' % (meta.shard_key, meta.model_name))
+        return meta.shard_for(value)
+
+    # 按主键查询，分片模型只查询所在分片
+    def _pk_query(self):
+        return self.objects.using(self._write_label()).filter(pk=self.pk)
+
+    def _insert_sql(self, upsert=False):
+        meta = self._meta
+        suffix = ''
+        if upsert:
+            suffix = self.objects._upsert_sql(auto_pk=self.pk is None)
+            if meta.primary_key and meta.backend.upsert_returning:
+                # 冲突更新时 lastrowid 不是已存在行的主键
+                suffix += ' returning `%s`' % meta.db_columns[meta.primary_key]
+        insert = 'insert into %s(%s) values (%s)%s;' % (
+            meta.table_info, ', '.join(meta.insert_columns), ', '.join(['%s'] * len(meta.field_list)), suffix)
+        return insert, tuple(self._field_values())
+
+    def _insert(self, upsert=False):
+        returning = upsert and self.__primary_key__ and self._meta.backend.upsert_returning
+        result = Database.execute(self._write_label(), *self._insert_sql(upsert),
+                                  fetch='one' if returning else 'none')
+        QuerySet.result_cache.invalidate(self._meta.table_info)
+        if self.__primary_key__:
+            self._set_inserted_pk(result[0] if returning else result.lastrowid)
 
-    def _insert(self):
-        insert = 'insert into %s(%s) values (%s);' % (
-            self.table_info(), ', '.join(self.field_info(x) for x in self.__dict__.keys()),
-            ', '.join(['%s'] * len(self.__dict__)))
-        cursor = Database.execute(self.__db_label__, insert, tuple(self.__dict__.values()))
+    async def _ainsert(self, upsert=False):
+        result = await AsyncDatabase.execute(self._write_label(), *self._insert_sql(upsert), fetch='none')
+        QuerySet.result_cache.invalidate(self._meta.table_info)
         if self.__primary_key__:
-            last_rowid = cursor.lastrowid
-            self._set_pk_val(last_rowid)
+            self._set_inserted_pk(result.lastrowid)
+
+    # 指定了主键且不是自增主键时 lastrowid 为 0，不覆盖已有主键
+    def _set_inserted_pk(self, lastrowid):
+        if self.pk is None or lastrowid:
+            self._set_pk_val(lastrowid)
+        _session_add(self)
 
-    def save(self):
+    # update_fields 校验
+    def _wash_update_fields(self, update_fields):
         if not self.__primary_key__ or not self.pk:
-            self._insert()
+            raise TypeError('Cannot use update_fields on an object without primary key.')
+        update_fields, _ = ModelCheck(self.objects.get_queryset().query).field_wash(update_fields)
+        return update_fields
+
+    # 只更新 update_fields 后同步快照中对应字段
+    def _snapshot_fields(self, update_fields):
+        original = getattr(self, '_original', None)
+        if original is not None:
+            values = dict(zip(self._loaded_fields(), original))
+            values.update((k, getattr(self, k)) for k in update_fields)
+            self._original = tuple(values[k] for k in self._loaded_fields())
+
+    # 修改分片键需要将行迁移到其它分片，save 不支持；按新分片键更新会覆盖其它分片中相同主键的行
+    def _check_shard_key(self):
+        shard_key = self._meta.shard_key
+        original = getattr(self, '_original', None)
+        if shard_key and original is not None and \
+                dict(zip(self._loaded_fields(), original))[shard_key] != getattr(self, shard_key):
+            raise TypeError('Cannot change shard key %s of a saved %s.' % (shard_key, self._meta.model_name))
+
+    # upsert=True 时使用单条 insert ... on duplicate key update，不再先查询是否存在
+    # 从数据库读取的对象只更新修改过的字段，update_fields 指定只更新部分字段
+    # 更新后重新加入会话（update 会从会话中移除该主键）
+    def save(self, upsert=False, update_fields=None):
+        self._check_shard_key()
+        primary_key = self.__primary_key__
+        original = getattr(self, '_original', None)
+        if update_fields is not None:
+            update_fields = self._wash_update_fields(update_fields)
+            if update_fields:
+                self._pk_query().update(**{k: getattr(self, k) for k in update_fields})
+                self._snapshot_fields(update_fields)
+                _session_add(self)
+            return
+
+        if upsert or not primary_key or not self.pk:
+            self._insert(upsert)
+        elif original is not None and dict(zip(self._loaded_fields(), original))[primary_key] == self.pk:
+            changed = self._changed_fields()
+            if not changed:
+                return
+            self._pk_query().update(**changed)
         else:
-            cls = self.__class__
-            filtered = cls.objects.filter(pk=self.pk)
+            filtered = self._pk_query().primary()
             if filtered.exists():
-                temp_dict = dict({}, **self.__dict__)
-                del temp_dict[self.__primary_key__]
+                temp_dict = dict(zip(self._meta.field_list, self._field_values()))
+                del temp_dict[primary_key]
                 filtered.update(**temp_dict)
             else:
                 self._insert()
+        self._snapshot()
+        _session_add(self)
+
+    # 异步保存，逻辑与 save 相同，使用 AsyncDatabase
+    async def asave(self, upsert=False, update_fields=None):
+        self._check_shard_key()
+        primary_key = self.__primary_key__
+        original = getattr(self, '_original', None)
+        if update_fields is not None:
+            update_fields = self._wash_update_fields(update_fields)
+            if update_fields:
+                await self._pk_query().aupdate(**{k: getattr(self, k) for k in update_fields})
+                self._snapshot_fields(update_fields)
+                _session_add(self)
+            return
+
+        if upsert or not primary_key or not self.pk:
+            await self._ainsert(upsert)
+        elif original is not None and dict(zip(self._loaded_fields(), original))[primary_key] == self.pk:
+            changed = self._changed_fields()
+            if not changed:
+                return
+            await self._pk_query().aupdate(**changed)
+        else:
+            filtered = self._pk_query().primary()
+            if await filtered.aexists():
+                temp_dict = dict(zip(self._meta.field_list, self._field_values()))
+                del temp_dict[primary_key]
+                await filtered.aupdate(**temp_dict)
+            else:
+                await self._ainsert()
+        self._snapshot()
+        _session_add(self)
 
     @classmethod
     def field_info(cls, field):
-        model_field = cls.attrs.get(field, None)
-        if not model_field:
+        try:
+            return cls._meta.columns[field]
+        except KeyError:
             raise TypeError('Cannot resolve keyword %s into field.' % field)
-        db_column = model_field.db_column or model_field.name
-        return '`%s`.`%s`' % (cls.__db_table__, db_column)
 
     @classmethod
     def table_info(cls):
-        self_info = cls.db_info('database')
-        return '`%s`.`%s`' % (self_info, cls.__db_table__) if self_info else '`%s`' % cls.__db_table__
+        return cls._meta.table_info
 
     @classmethod
     def db_info(cls, key):
@@ -939,43 +2861,517 @@ class Model(metaclass=MetaModel):
         return self_config.get(key)
 
 
+# 分片结果归并时的排序键，支持降序字段，NULL 排在最前
+class _MergeKey:
+    __slots__ = ('values', 'desc')
+
+    def __init__(self, values, desc):
+        self.values = [(x is not None, x) for x in values]
+        self.desc = desc
+
+    def __lt__(self, other):
+        for value, other_value, desc in zip(self.values, other.values, self.desc):
+            if value != other_value:
+                return value > other_value if desc else value < other_value
+        return False
+
+
+# 写操作的影响行数及自增主键
+ExecuteResult = namedtuple('ExecuteResult', ['rowcount', 'lastrowid'])
+
+# 执行监控：执行前后回调、慢查询日志、sql 编译及结果转换耗时统计
+class Instrumentation:
+    # hook(db_label, sql, params)
+    pre_execute = []
+    # hook(db_label, sql, params, duration, rowcount)
+    post_execute = []
+    # 慢查询阈值（秒），超过时记录 warning 日志，None 不记录
+    slow_query_time = None
+    # 为 True 时统计 Query.sql_expr 编译及 data_to_obj 转换耗时，timers 为 {名称: [次数/行数, 秒]}
+    timing = False
+    timers = {'compile': [0, 0.0], 'hydrate': [0, 0.0]}
+    _lock = threading.Lock()
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls.pre_execute or cls.post_execute or cls.slow_query_time is not None or _query_counters.get())
+
+    @classmethod
+    def before(cls, db_label, sql, params):
+        for hook in cls.pre_execute:
+            hook(db_label, sql, params)
+
+    @classmethod
+    def after(cls, db_label, sql, params, duration, rowcount):
+        for hook in cls.post_execute:
+            hook(db_label, sql, params, duration, rowcount)
+        if cls.slow_query_time is not None and duration >= cls.slow_query_time:
+            logger.warning('Slow query (%.3fs) on %s: %s %r', duration, db_label, sql, params)
+        for counter in _query_counters.get():
+            counter.record(db_label, sql, params, duration, rowcount)
+
+    @classmethod
+    def record(cls, name, count, duration):
+        with cls._lock:
+            timer = cls.timers[name]
+            timer[0] += count
+            timer[1] += duration
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            for timer in cls.timers.values():
+                timer[0], timer[1] = 0, 0.0
+
+
+# 查询计数，记录上下文中执行的查询，可用于测试断言
+# 同一sql（参数不同）执行次数达到 n_plus_one 时视为 N+1 查询，记录 warning 日志并加入 flagged
+class QueryCounter:
+    def __init__(self, n_plus_one=None):
+        self.n_plus_one = n_plus_one
+        self.queries = []
+        self.shapes = {}
+        self.flagged = []
+        self._tokens = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._tokens.append(_query_counters.set(_query_counters.get() + (self,)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _query_counters.reset(self._tokens.pop())
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def record(self, db_label, sql, params, duration, rowcount):
+        with self._lock:
+            self.queries.append((db_label, sql, params, duration, rowcount))
+            times = self.shapes[sql] = self.shapes.get(sql, 0) + 1
+        if times == self.n_plus_one:
+            self.flagged.append(sql)
+            logger.warning('Possible N+1 query, executed %s times: %s', times, sql)
+
+
+_query_counters = contextvars.ContextVar('query_counters', default=())
+
+
+# 当前上下文中执行过写操作的数据库，用于读己之写
+_written_labels = contextvars.ContextVar('written_labels', default=None)
+# 当前线程/协程中事务块固定使用的连接 {db_label: (连接, 嵌套层数)}
+_atomic_blocks = contextvars.ContextVar('atomic_blocks', default={})
+
+
 # 数据库调用
 class Database:
     conn = {}
     db_config = {}
-
+    # 各库的数据库方言
+    backends = {}
+    # 只读从库连接池
+    replicas = {}
+    # 各连接池正在使用的连接数
+    outstanding = {}
+    _round_robin = {}
+    _lock = threading.Lock()
+    # 分片查询并发线程数
+    fan_out_workers = 16
+    _executor = None
+
+    # 从库配置 replicas 为列表，未填写的配置项与主库相同
+    # replica_policy: round_robin（默认）或 least_outstanding
     @classmethod
     def connect(cls, **databases):
         for db_label, db_config in databases.items():
-            cls.conn[db_label] = pymysqlpool.ConnectionPool(size=db_config.get('pool_min', 1),
-                                                            maxsize=db_config.get('pool_max', 1),
-                                                            pre_create_num=db_config.get('pool_min', 1),
-                                                            name=db_config.get('database', 'test'),
-                                                            host=db_config.get('host', 'localhost'),
-                                                            port=int(db_config.get('port', 3306)),
-                                                            user=db_config.get('user', 'root'),
-                                                            password=db_config.get('password', ''),
-                                                            database=db_config.get('database', 'test'),
-                                                            charset=db_config.get('charset', 'utf8'),
-                                                            autocommit=True)
+            backend = db_config.get('backend', 'mysql')
+            backend = cls.backends[db_label] = BACKENDS[backend]() if isinstance(backend, str) else backend
+            cls.conn[db_label] = backend.create_pool(db_config)
+            replicas = [backend.create_pool(dict(db_config, **x)) for x in db_config.get('replicas', [])]
+            cls.replicas[db_label] = replicas
+            cls._round_robin[db_label] = cycle(replicas)
         cls.db_config.update(**databases)
+        for db_label in databases:
+            Options.expire(db_label)
+        # 库名变化会影响已编译的sql
+        Query.sql_cache.clear()
+
+    @classmethod
+    def get_backend(cls, db_label):
+        backend = cls.backends.get(db_label)
+        if backend is None:
+            backend = cls.backends[db_label] = MySQLBackend()
+        return backend
+
+    # 读操作使用从库，写操作、未配置从库或读己之写时使用主库
+    @classmethod
+    def get_pool(cls, db_label, read=False):
+        replicas = cls.replicas.get(db_label)
+        if not read or not replicas:
+            return cls.conn[db_label]
+        written = _written_labels.get()
+        if written is not None and db_label in written:
+            return cls.conn[db_label]
+        if cls.db_config.get(db_label, {}).get('replica_policy') == 'least_outstanding':
+            return min(replicas, key=lambda x: cls.outstanding.get(x, 0))
+        with cls._lock:
+            return next(cls._round_robin[db_label])
+
+    # 取得连接，退出时放回连接池
+    @classmethod
+    @contextmanager
+    def connection(cls, db_label, read=False):
+        blocks = _atomic_blocks.get()
+        if db_label in blocks:
+            yield blocks[db_label][0]
+            return
+        pool = cls.get_pool(db_label, read)
+        if not read:
+            written = _written_labels.get()
+            if written is not None:
+                written.add(db_label)
+        with cls._lock:
+            cls.outstanding[pool] = cls.outstanding.get(pool, 0) + 1
+        try:
+            db_conn = pool.get_connection()
+            with db_conn:
+                yield db_conn
+        finally:
+            with cls._lock:
+                cls.outstanding[pool] -= 1
+
+    # 事务块，可作为上下文管理器或装饰器使用
+    # 块内同一线程/协程对该库的操作复用同一连接，关闭自动提交，结束时提交一次，嵌套时使用保存点
+    @classmethod
+    @contextmanager
+    def atomic(cls, db_label='default'):
+        blocks = _atomic_blocks.get()
+        if db_label in blocks:
+            db_conn, depth = blocks[db_label]
+            savepoint = 'sp_%s' % depth
+            token = _atomic_blocks.set(dict(blocks, **{db_label: (db_conn, depth + 1)}))
+            try:
+                with db_conn.cursor() as cursor:
+                    cursor.execute('savepoint %s' % savepoint)
+                try:
+                    yield db_conn
+                except BaseException:
+                    with db_conn.cursor() as cursor:
+                        cursor.execute('rollback to savepoint %s' % savepoint)
+                    raise
+                with db_conn.cursor() as cursor:
+                    cursor.execute('release savepoint %s' % savepoint)
+            finally:
+                _atomic_blocks.reset(token)
+            return
+        with cls.connection(db_label) as db_conn:
+            db_conn.autocommit(False)
+            db_conn.begin()
+            token = _atomic_blocks.set(dict(blocks, **{db_label: (db_conn, 1)}))
+            try:
+                yield db_conn
+            except BaseException:
+                db_conn.rollback()
+                raise
+            else:
+                db_conn.commit()
+            finally:
+                _atomic_blocks.reset(token)
+
+    # 在多个库并发执行 func(db_label)，结果按 db_labels 顺序返回
+    @classmethod
+    def fan_out(cls, func, db_labels):
+        if len(db_labels) == 1:
+            return [func(db_labels[0])]
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.fan_out_workers, thread_name_prefix='fan_out')
+        futures = [cls._executor.submit(contextvars.copy_context().run, func, x) for x in db_labels]
+        return [x.result() for x in futures]
+
+    # 读己之写：上下文中对某个库执行写操作后，该库的读操作改用主库
+    @classmethod
+    @contextmanager
+    def read_your_writes(cls):
+        token = _written_labels.set(set())
+        try:
+            yield
+        finally:
+            _written_labels.reset(token)
 
+    # 在连接放回连接池之前完成读取，不返回游标
+    # fetch: all 返回全部行，one 返回第一行或 None，none 返回 ExecuteResult(rowcount, lastrowid)，
+    # stream 返回分批读取的生成器
     @classmethod
-    def execute(cls, db_label, *args):
-        db_conn = cls.conn[db_label].get_connection()
-        with db_conn:
+    def execute(cls, db_label, sql, params=None, fetch='all', read=False):
+        if fetch == 'stream':
+            return cls.stream(db_label, sql, params, read=read)
+        if fetch not in ('all', 'one', 'none'):
+            raise TypeError('Invalid fetch mode: %s' % fetch)
+        instrumented = Instrumentation.enabled()
+        if instrumented:
+            Instrumentation.before(db_label, sql, params)
+            start = time.perf_counter()
+        with cls.connection(db_label, read) as db_conn:
             with db_conn.cursor() as cursor:
-                cursor.execute(*args)
-                return cursor
+                cursor.execute(sql, params)
+                if fetch == 'all':
+                    result = cursor.fetchall()
+                elif fetch == 'one':
+                    result = cursor.fetchone()
+                else:
+                    result = ExecuteResult(cursor.rowcount, cursor.lastrowid)
+                rowcount = cursor.rowcount
+        if instrumented:
+            Instrumentation.after(db_label, sql, params, time.perf_counter() - start, rowcount)
+        return result
 
     @classmethod
-    def executemany(cls, db_label, *args):
-        db_conn = cls.conn[db_label].get_connection()
-        with db_conn:
+    def executemany(cls, db_label, sql, seq_params):
+        instrumented = Instrumentation.enabled()
+        if instrumented:
+            Instrumentation.before(db_label, sql, seq_params)
+            start = time.perf_counter()
+        with cls.connection(db_label) as db_conn:
             with db_conn.cursor() as cursor:
-                cursor.executemany(*args)
-                return cursor
+                cursor.executemany(sql, seq_params)
+                result = ExecuteResult(cursor.rowcount, cursor.lastrowid)
+        if instrumented:
+            Instrumentation.after(db_label, sql, seq_params, time.perf_counter() - start, result.rowcount)
+        return result
+
+    # 服务端游标分批读取，生成器结束或关闭时才将连接放回连接池
+    # 事务块内与块内其它查询共用同一连接，未读完的服务端游标会被下一条查询丢弃，
+    # 因此使用普通游标一次读取全部结果后再分批返回，内存占用与结果集大小相关
+    @classmethod
+    def stream(cls, db_label, sql, params=None, chunk_size=2000, read=False):
+        if db_label in _atomic_blocks.get():
+            rows = cls.execute(db_label, sql, params, read=read)
+            for index in range(0, len(rows), chunk_size):
+                yield rows[index:index + chunk_size]
+            return
+        instrumented = Instrumentation.enabled()
+        if instrumented:
+            Instrumentation.before(db_label, sql, params)
+            start = time.perf_counter()
+        rowcount = 0
+        with cls.connection(db_label, read) as db_conn:
+            with db_conn.cursor(cls.get_backend(db_label).stream_cursor) as cursor:
+                cursor.execute(sql, params)
+                try:
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        rowcount += len(rows)
+                        yield rows
+                except GeneratorExit:
+                    # 提前关闭时，关闭游标会丢弃剩余结果，连接可正常放回连接池
+                    return
+                finally:
+                    # 耗时为读取完或关闭时的总耗时
+                    if instrumented:
+                        Instrumentation.after(db_label, sql, params, time.perf_counter() - start, rowcount)
+
+
+# SQLite 参数占位符由 %s 转换为 ?，in 查询的序列参数展开
+_param_re = re.compile(r'%s|%%')
+
 
+def _qmark(sql, params):
+    if not params:
+        return sql.replace('%%', '%'), ()
+    params = iter(params)
+    new_params = []
+
+    def replace(match):
+        if match.group() == '%%':
+            return '%'
+        value = next(params)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            new_params.extend(value)
+            return '(%s)' % ', '.join(['?'] * len(value))
+        new_params.append(value)
+        return '?'
+
+    return _param_re.sub(replace, sql), new_params
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def execute(self, sql, params=None):
+        self._cursor.execute(*_qmark(sql, params))
+        return self._cursor.rowcount
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        sql = _qmark(sql, seq_params[0] if seq_params else ())[0]
+        self._cursor.executemany(sql, seq_params)
+        return self._cursor.rowcount
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# 与 pymysqlpool 连接接口相同，退出 with 时放回连接池
+class SQLiteConnection:
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = sqlite3.connect(pool.database, uri=True, check_same_thread=False, isolation_level=None)
+        self._autocommit = True
+
+    def cursor(self, cursor=None):
+        return SQLiteCursor(self._conn.cursor())
+
+    def autocommit(self, value):
+        self._autocommit = value
+
+    def get_autocommit(self):
+        return self._autocommit
+
+    def begin(self):
+        self._conn.execute('begin')
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self._conn.execute('commit')
 
-def execute_raw_sql(db_label, sql, params=None):
-    return Database.execute(db_label, sql, params)
+    def rollback(self):
+        if self._conn.in_transaction:
+            self._conn.execute('rollback')
+
+    def close(self):
+        self._pool.put_connection(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._pool.put_connection(self)
+
+
+class SQLitePool:
+    _memory_count = 0
+
+    def __init__(self, database, maxsize=1):
+        if database == ':memory:':
+            # 同一连接池的连接共享内存库，保持一个连接使内存库不被释放
+            SQLitePool._memory_count += 1
+            database = 'file:memory_%s_%s?mode=memory&cache=shared' % (id(self), SQLitePool._memory_count)
+        self.database = database
+        self.maxsize = maxsize
+        self._idle = [SQLiteConnection(self)]
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return SQLiteConnection(self)
+
+    def put_connection(self, conn):
+        conn.rollback()
+        conn.autocommit(True)
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn._conn.close()
+
+
+# 异步数据库调用，需要安装 aiomysql，配置与 Database 相同
+class AsyncDatabase:
+    pools = {}
+
+    @classmethod
+    async def connect(cls, **databases):
+        if aiomysql is None:
+            raise TypeError('AsyncDatabase requires aiomysql.')
+        for db_label, db_config in databases.items():
+            cls.pools[db_label] = await aiomysql.create_pool(minsize=db_config.get('pool_min', 1),
+                                                             maxsize=db_config.get('pool_max', 1),
+                                                             host=db_config.get('host', 'localhost'),
+                                                             port=int(db_config.get('port', 3306)),
+                                                             user=db_config.get('user', 'root'),
+                                                             password=db_config.get('password', ''),
+                                                             db=db_config.get('database', 'test'),
+                                                             charset=db_config.get('charset', 'utf8'),
+                                                             autocommit=True)
+        Database.db_config.update(**databases)
+        for db_label in databases:
+            Options.expire(db_label)
+        Query.sql_cache.clear()
+
+    @classmethod
+    async def close(cls):
+        for pool in cls.pools.values():
+            pool.close()
+            await pool.wait_closed()
+        cls.pools.clear()
+
+    # fetch 与 Database.execute 相同，stream 返回异步生成器
+    @classmethod
+    async def execute(cls, db_label, sql, params=None, fetch='all'):
+        if fetch == 'stream':
+            return cls.stream(db_label, sql, params)
+        if fetch not in ('all', 'one', 'none'):
+            raise TypeError('Invalid fetch mode: %s' % fetch)
+        instrumented = Instrumentation.enabled()
+        if instrumented:
+            Instrumentation.before(db_label, sql, params)
+            start = time.perf_counter()
+        async with cls.pools[db_label].acquire() as db_conn:
+            async with db_conn.cursor() as cursor:
+                await cursor.execute(sql, params)
+                if fetch == 'all':
+                    result = await cursor.fetchall()
+                elif fetch == 'one':
+                    result = await cursor.fetchone()
+                else:
+                    result = ExecuteResult(cursor.rowcount, cursor.lastrowid)
+                rowcount = cursor.rowcount
+        if instrumented:
+            Instrumentation.after(db_label, sql, params, time.perf_counter() - start, rowcount)
+        return result
+
+    # 服务端游标分批读取
+    @classmethod
+    async def stream(cls, db_label, sql, params=None, chunk_size=2000):
+        async with cls.pools[db_label].acquire() as db_conn:
+            async with db_conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(sql, params)
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
+
+def execute_raw_sql(db_label, sql, params=None, fetch='all'):
+    return Database.execute(db_label, sql, params, fetch=fetch)
@@ -0,0 +1,282 @@
+# coding: utf-8
+# 离线回归测试，不需要 MySQL，使用 SQLite 内存库代替
+# python offline_test.py，或 python -m pytest offline_test.py
+import io
+import os
+import sys
+import tempfile
+import traceback
+from decimal import Decimal
+
+from data_handler import Database, Model, Field, Session, SQLiteBackend, Instrumentation, QuerySet, \
+    execute_raw_sql
+
+
+# 自定义运算符的方言，iexact 使用 like（SQLite 的 like 不区分大小写）
+class LikeBackend(SQLiteBackend):
+    operators = dict(SQLiteBackend.operators, iexact=' like %s ')
+
+
+Database.connect(
+    default={'backend': 'sqlite', 'database': ':memory:'},
+    # 从库为独立的内存库，不同步主库的数据
+    rw={'backend': 'sqlite', 'database': ':memory:', 'replicas': [{'database': ':memory:'}]},
+    s0={'backend': 'sqlite', 'database': ':memory:'},
+    s1={'backend': 'sqlite', 'database': ':memory:'},
+    custom={'backend': LikeBackend(), 'database': ':memory:'},
+    step={'backend': 'sqlite', 'database': ':memory:', 'auto_increment_increment': 2},
+)
+for sql in ('create table test (id integer primary key autoincrement, a text, bb integer)',
+            'create table test_foreign (id integer primary key autoincrement, a text, c integer)',
+            'create table test_code (code text primary key, a text)'):
+    execute_raw_sql('default', sql, fetch='none')
+for db_label in ('s0', 's1'):
+    execute_raw_sql(db_label, 'create table orders (id integer primary key, user_id integer, amount integer)',
+                    fetch='none')
+Database.execute('rw', 'create table test (id integer primary key, a text, bb integer)', fetch='none')
+Database.execute('rw', 'create table test (id integer primary key, a text, bb integer)', fetch='none', read=True)
+execute_raw_sql('custom', 'create table test (id integer primary key autoincrement, a text, bb integer)', fetch='none')
+
+
+class TestModel(Model):
+    id = Field(primary_key=True)
+    a = Field()
+    b = Field(db_column='bb')
+
+    class Meta:
+        db_table = 'test'
+        db_label = 'default'
+
+
+class TestForeignModel(Model):
+    id = Field(primary_key=True)
+    a = Field()
+    c = Field()
+
+    class Meta:
+        db_table = 'test_foreign'
+        db_label = 'default'
+
+
+class TestCodeModel(Model):
+    code = Field(primary_key=True)
+    a = Field()
+
+    class Meta:
+        db_table = 'test_code'
+        db_label = 'default'
+
+
+class ReplicaModel(Model):
+    id = Field(primary_key=True)
+    a = Field()
+    b = Field(db_column='bb')
+
+    class Meta:
+        db_table = 'test'
+        db_label = 'rw'
+
+
+class CustomModel(Model):
+    id = Field(primary_key=True)
+    a = Field()
+    b = Field(db_column='bb')
+
+    class Meta:
+        db_table = 'test'
+        db_label = 'custom'
+
+
+class Order(Model):
+    id = Field(primary_key=True)
+    user_id = Field()
+    amount = Field()
+
+    class Meta:
+        db_table = 'orders'
+        shards = ['s0', 's1']
+        shard_key = 'user_id'
+        shard_func = lambda value: 's%d' % (value % 2)
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def reset():
+    for model in (TestModel, TestForeignModel, TestCodeModel):
+        model.objects.all().delete()
+
+
+# 修改已保存对象的分片键会写入错误的分片
+def test_shard_key_change():
+    order = Order(id=1, user_id=1, amount=10)
+    order.save()
+    order.user_id = 2
+    try:
+        order.save()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('save() accepted a shard key change')
+    check(Order.objects.using('s0').filter(pk=1).count() == 0, 'row written to the new shard')
+    check(Order.objects.filter(user_id=1).get(pk=1).amount == 10, 'row changed on the old shard')
+
+
+# 事务内不使用也不写入结果缓存，回滚后读取到提交的数据
+def test_cache_atomic_rollback():
+    reset()
+    obj = TestModel.objects.create(a='committed', b=1)
+    try:
+        with Database.atomic('default'):
+            TestModel.objects.filter(pk=obj.pk).update(a='rolled back')
+            check(TestModel.objects.cache().get(pk=obj.pk).a == 'rolled back', 'atomic read')
+            raise ValueError
+    except ValueError:
+        pass
+    check(TestModel.objects.cache().get(pk=obj.pk).a == 'committed', 'cache kept rolled back data')
+
+
+# 子查询中的表变化时缓存失效
+def test_cache_subquery_invalidation():
+    reset()
+    obj = TestModel.objects.create(a='x', b=1)
+    TestForeignModel.objects.create(a='x', c=obj.pk)
+    qs = TestModel.objects.filter(id__in=TestForeignModel.objects.values_list('c')).cache()
+    check(qs.count() == 1, 'subquery count')
+    TestForeignModel.objects.all().delete()
+    check(qs.count() == 0, 'cache not invalidated by subquery table')
+
+
+# save() 判断行是否存在时使用主库，从库没有该行时不能插入重复主键
+def test_save_exists_on_primary():
+    ReplicaModel(id=7, a='x', b=1).save()
+    ReplicaModel(id=7, a='y', b=2).save()
+    check(ReplicaModel.objects.primary().get(pk=7).a == 'y', 'save() did not update the row')
+
+
+# 会话中更新、删除的行不再从会话中返回
+def test_session_update_delete():
+    reset()
+    obj = TestModel.objects.create(a='x', b=1)
+    with Session():
+        check(TestModel.objects.get(pk=obj.pk).a == 'x', 'session get')
+        TestModel.objects.filter(pk=obj.pk).update(a='y')
+        check(TestModel.objects.get(pk=obj.pk).a == 'y', 'session returned updated row')
+        TestModel.objects.filter(pk=obj.pk).delete()
+        check(TestModel.objects.filter(pk=obj.pk).first() is None, 'session returned deleted row')
+        check(TestModel.objects.in_bulk([obj.pk]) == {}, 'in_bulk returned deleted row')
+
+
+# 自定义方言的运算符，参数不同时 sql 缓存不能丢失参数
+def test_custom_backend_operator():
+    CustomModel.objects.bulk_create([CustomModel(a='FOO', b=1), CustomModel(a='bar', b=2)])
+    check(list(CustomModel.objects.filter(a__iexact='foo').values_list('a', flat=True)) == ['FOO'], 'iexact foo')
+    check(list(CustomModel.objects.filter(a__iexact='BAR').values_list('a', flat=True)) == ['bar'], 'iexact bar')
+
+
+# 批量更新按参数个数分批，更新后快照刷新，save() 不再写入
+def test_bulk_update_batches():
+    reset()
+    TestModel.objects.bulk_create([TestModel(a='x', b=i) for i in range(20000)])
+    objs = list(TestModel.objects.all())
+    for obj in objs:
+        obj.b += 1
+    statements = []
+
+    def hook(db_label, sql, params):
+        statements.append(len(params or ()))
+
+    Instrumentation.pre_execute.append(hook)
+    try:
+        TestModel.objects.bulk_update(objs, ['b'], batch_size=20000)
+        max_params = TestModel._meta.backend.max_params
+        check(len(statements) > 1 and max(statements) <= max_params, 'bulk_update params %s' % statements)
+        del statements[:]
+        objs[0].save()
+        check(statements == [], 'save() after bulk_update wrote %s' % statements)
+    finally:
+        Instrumentation.pre_execute.remove(hook)
+    check(TestModel.objects.filter(b__gte=1).count() == 20000, 'bulk_update count')
+
+
+# upsert 冲突时保留调用方指定的主键
+def test_upsert_keeps_pk():
+    reset()
+    TestCodeModel(code='abc', a='x').save()
+    obj = TestCodeModel(code='abc', a='y')
+    obj.save(upsert=True)
+    check(obj.pk == 'abc', 'upsert changed pk to %r' % obj.pk)
+    check(TestCodeModel.objects.get(pk='abc').a == 'y', 'upsert did not update')
+
+
+# 事务内 iterator() 读取到未提交的数据，且不影响事务中的后续写入
+def test_iterator_atomic():
+    reset()
+    with Database.atomic('default'):
+        TestModel.objects.bulk_create([TestModel(a='x', b=i) for i in range(5)])
+        check([x.b for x in TestModel.objects.order_by('b').iterator(2)] == list(range(5)), 'atomic iterator')
+        TestModel.objects.create(a='x', b=5)
+    check(TestModel.objects.count() == 6, 'atomic block not committed')
+
+
+# 各批推断的类型不同时提升，不截断数值
+def test_to_columns_promotion():
+    reset()
+    TestModel.objects.bulk_create([TestModel(a='x', b=1), TestModel(a=None, b=2.5)])
+    columns = TestModel.objects.order_by('id').to_columns('a', 'b', chunk_size=1)
+    check(list(columns['b'].values) == [1, 2.5], 'to_columns values %s' % columns['b'].values)
+    check(list(columns['a'].mask) == [False, True], 'to_columns mask %s' % columns['a'].mask)
+
+
+# 第一批全部为 NULL 的列、没有数据的导出、decimal 精度、gzip 与文本文件
+def test_export():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        pyarrow = None
+    try:
+        TestModel.objects.export(io.StringIO(), gzip=True)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('gzip export accepted a text file')
+    if pyarrow is None:
+        return
+    reset()
+    TestModel.objects.bulk_create([TestModel(a=None, b=1), TestModel(a='x', b=2)])
+    path = os.path.join(tempfile.mkdtemp(), 'test.parquet')
+    check(TestModel.objects.order_by('id').export(path, format='parquet', chunk_size=1) == 2, 'parquet count')
+    table = pyarrow.parquet.read_table(path)
+    check(table.column('a').to_pylist() == [None, 'x'], 'parquet null column %s' % table.column('a'))
+    check(TestModel.objects.filter(b__gt=100).export(path, format='parquet') == 0, 'empty parquet count')
+    check(pyarrow.parquet.read_table(path).column_names == ['id', 'a', 'b'], 'empty parquet columns')
+    for value in (Decimal('1.50'), Decimal('12345.67')):
+        check(QuerySet._parquet_array([value]).type == pyarrow.decimal128(38, 2), 'decimal precision')
+
+
+# 多行 insert 返回的主键按自增步长递增
+def test_auto_increment_step():
+    check(TestModel.objects._insert_step('step') == 2, 'configured auto_increment_increment')
+    check(SQLiteBackend().first_insert_id(7, 3, 2) == 3, 'sqlite first_insert_id with step')
+    objs = [TestModel(a='x', b=i) for i in range(3)]
+    TestModel.objects.bulk_create(objs, return_pks=True)
+    check([TestModel.objects.get(pk=x.pk).b for x in objs] == [0, 1, 2], 'return_pks')
+
+
+def main():
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    errors = 0
+    for test in tests:
+        try:
+            test()
+        except Exception:
+            errors += 1
+            sys.stderr.write('%s failed\n%s\n' % (test.__name__, traceback.format_exc()))
+    sys.stdout.write('%d tests, %d errors\n' % (len(tests), errors))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# coding: utf-8
+# 多线程压力测试，不需要 MySQL，使用 SQLite 数据库代替
+# 每个线程读写只属于自己的行，检查读取到的结果没有混入其它线程的数据
+# 连接池模拟 pymysql：结果缓存在连接上，连接放回连接池后立即交给其它线程，并覆盖其中未读取的结果，
+# 放回连接后才读取结果时会读到错误的数据
+# python stress_test.py --threads 32 --rounds 20
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from data_handler import Database, Model, Field, F, Session, SQLiteConnection, execute_raw_sql
+
+# 放回连接池时写入连接的结果
+RELEASED_ROWS = [('<released>', '<released>', '<released>')] * 3
+
+
+# 结果保存在连接上，与 pymysql 相同，同一连接上的下一条语句会覆盖上一条的结果
+class RacyCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def rowcount(self):
+        return self.conn.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.conn.lastrowid
+
+    def execute(self, sql, params=None):
+        with self.conn.sqlite.cursor() as cursor:
+            cursor.execute(sql, params)
+            self.conn.set_result(list(cursor.fetchall()), cursor.rowcount, cursor.lastrowid)
+        # 让出 GIL，增加其它线程取得连接的机会
+        time.sleep(0)
+        return self.conn.rowcount
+
+    def executemany(self, sql, seq_params):
+        with self.conn.sqlite.cursor() as cursor:
+            cursor.executemany(sql, seq_params)
+            self.conn.set_result([], cursor.rowcount, cursor.lastrowid)
+        return self.conn.rowcount
+
+    def fetchall(self):
+        return self.fetchmany(len(self.conn.rows))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size):
+        conn = self.conn
+        rows = conn.rows[conn.pos:conn.pos + size]
+        conn.pos += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RacyConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.sqlite = SQLiteConnection(pool.sqlite_pool)
+        self.set_result([], -1, None)
+
+    def set_result(self, rows, rowcount, lastrowid):
+        self.rows = rows
+        self.pos = 0
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    def cursor(self, cursor=None):
+        return RacyCursor(self)
+
+    def autocommit(self, value):
+        self.sqlite.autocommit(value)
+
+    def begin(self):
+        self.sqlite.begin()
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.put_connection(self)
+
+
+class RacyPool:
+    def __init__(self, sqlite_pool):
+        self.sqlite_pool = sqlite_pool
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return RacyConnection(self)
+
+    # 覆盖未读取的结果，并使该连接最先被下一个线程取得
+    def put_connection(self, conn):
+        conn.rollback()
+        conn.autocommit(True)
+        conn.set_result(list(RELEASED_ROWS), -1, None)
+        with self._lock:
+            self._idle.append(conn)
+
+
+class StressModel(Model):
+    id = Field(primary_key=True)
+    a = Field()
+    b = Field(db_column='bb')
+
+    class Meta:
+        db_table = 'stress'
+        db_label = 'default'
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def worker(index, rounds, errors):
+    tag = 't%d' % index
+    try:
+        for n in range(rounds):
+            name = '%s_%d' % (tag, n)
+            # 单条插入
+            obj = StressModel(a=name, b=0)
+            obj.save()
+            check(obj.pk is not None, '%s: save() did not set pk' % name)
+
+            # 批量插入并返回主键
+            objs = [StressModel(a=name, b=i) for i in range(1, 10)]
+            StressModel.objects.bulk_create(objs, return_pks=True)
+            check(len({x.pk for x in objs}) == 9, '%s: bulk_create() pks %s' % (name, [x.pk for x in objs]))
+            pks = [obj.pk] + [x.pk for x in objs]
+
+            # 读取只属于本线程的行
+            rows = list(StressModel.objects.filter(a=name).order_by('b').values_list('id', 'b'))
+            check(rows == [(pk, b) for b, pk in enumerate(pks)], '%s: select %s' % (name, rows))
+            check(StressModel.objects.filter(a=name).count() == 10, '%s: count' % name)
+            check([x.a for x in StressModel.objects.filter(a=name).iterator(3)] == [name] * 10,
+                  '%s: iterator' % name)
+            check(StressModel.objects.get(pk=obj.pk).a == name, '%s: get' % name)
+            check(sorted(StressModel.objects.in_bulk(pks)) == sorted(pks), '%s: in_bulk' % name)
+
+            # 事务内更新，同一线程复用同一连接
+            with Database.atomic('default'):
+                StressModel.objects.filter(a=name).update(b=F('b') + 100)
+                check(StressModel.objects.filter(a=name, b__gte=100).count() == 10, '%s: atomic read' % name)
+
+            # 回滚不影响其它线程
+            try:
+                with Database.atomic('default'):
+                    StressModel.objects.filter(a=name).update(b=-1)
+                    raise ValueError
+            except ValueError:
+                pass
+            check(StressModel.objects.filter(a=name, b=-1).count() == 0, '%s: rollback' % name)
+
+            # 批量更新
+            for x in objs:
+                x.b = 1000 + x.b
+            StressModel.objects.bulk_update(objs, ['b'])
+            check(StressModel.objects.filter(a=name, b__gte=1000).count() == 9, '%s: bulk_update' % name)
+
+            # 会话中同一主键只对应一个对象
+            with Session():
+                first = StressModel.objects.filter(pk=obj.pk).first()
+                check(StressModel.objects.get(pk=obj.pk) is first, '%s: session' % name)
+
+            StressModel.objects.filter(a=name).delete()
+            check(not StressModel.objects.filter(a=name).exists(), '%s: delete' % name)
+    except Exception as e:
+        errors.append('%s: %r' % (tag, e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-threaded stress test for data_handler.')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--database', help='SQLite database file, default is a temporary file')
+    args = parser.parse_args()
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'stress.db')
+    Database.connect(default={'backend': 'sqlite', 'database': database, 'pool_max': args.threads})
+    Database.conn['default'] = RacyPool(Database.conn['default'])
+    execute_raw_sql('default', 'drop table if exists stress;', fetch='none')
+    execute_raw_sql('default', 'create table stress (id integer primary key autoincrement, a text, bb integer);',
+                    fetch='none')
+    execute_raw_sql('default', 'create index stress_a on stress (a);', fetch='none')
+
+    errors = []
+    threads = [threading.Thread(target=worker, args=(i, args.rounds, errors)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    left = StressModel.objects.count()
+    if left:
+        errors.append('%d rows left after all threads finished' % left)
+    for error in errors:
+        sys.stderr.write(error + '\n')
+    sys.stdout.write('%d threads x %d rounds in %.2fs, %d errors\n' % (args.threads, args.rounds, seconds, len(errors)))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -90,6 +90,10 @@ if r:
 first = filter_result[0]
 print(first == r)
 
+# iterator
+for r in filter_result.iterator(chunk_size=2):
+    print(r.a)
+
 # update
 first.a = 'Rick Sanchez'
 first.save()